@@ -0,0 +1,131 @@
+import docker
+import sys
+from dbb.build_log import build_log
+
+class apt_cache(object):
+    """
+    Manage an apt-cacher-ng caching proxy container, used as the
+    http proxy for image builds
+    """
+    cache_dir = '/var/cache/apt-cacher-ng'
+    log_file = '/var/log/apt-cacher-ng/apt-cacher.log'
+
+    def __init__(self, config, client):
+        self.config = config
+        self.c = client
+        self.settings = config.apt_cache
+
+    @property
+    def name(self):
+        return self.settings['name']
+
+    def _inspect(self, inspect, name):
+        try:
+            return inspect(name)
+        except docker.errors.APIError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            return None
+
+    def container(self):
+        return self._inspect(self.c.inspect_container, self.name)
+
+    def is_running(self):
+        # An externally managed cache is assumed to be up
+        if self.settings['url']:
+            return True
+        c = self.container()
+        return c is not None and c['State']['Running']
+
+    @property
+    def proxy_url(self):
+        """URL of the cache, reachable from build containers"""
+        if self.settings['url']:
+            return self.settings['url']
+        ip = self.container()['NetworkSettings']['IPAddress']
+        return 'http://%s:%s' % (ip, self.settings['port'])
+
+    def start(self):
+        if self.settings['url']:
+            sys.stderr.write("Error:  cache at %s is externally managed\n" % \
+                                 self.settings['url'])
+            sys.exit(1)
+        if self.is_running():
+            sys.stderr.write("Package cache already running at %s\n" % \
+                                 self.proxy_url)
+            return
+        if self.container() is None:
+            image = self.settings['image']
+            if self._inspect(self.c.inspect_image, image) is None:
+                sys.stderr.write("Pulling %s\n" % image)
+                log = build_log()
+                for event in log.events(self.c.pull(image, stream=True)):
+                    log.write(event)
+            self.c.create_container(
+                image = image,
+                name = self.name,
+                detach = True,
+                ports = [self.settings['port']],
+                volumes = [self.cache_dir],
+                host_config = self.c.create_host_config(
+                    binds = {
+                        self.settings['volume'] : dict(
+                            bind = self.cache_dir,
+                            mode = 'rw',
+                            ),
+                        },
+                    port_bindings = {
+                        self.settings['port'] : self.settings['port'],
+                        },
+                    restart_policy = dict(Name = 'unless-stopped'),
+                    )
+                )
+        self.c.start(self.name)
+        sys.stderr.write("Package cache started at %s\n" % self.proxy_url)
+
+    def stop(self):
+        if self.settings['url'] or not self.is_running():
+            sys.stderr.write("Error:  package cache is not running\n")
+            sys.exit(1)
+        self.c.stop(self.name)
+        sys.stderr.write("Package cache stopped\n")
+
+    def read_log(self):
+        """Read the cache's transfer log from the container"""
+        e = self.c.exec_create(self.name, ['cat', self.log_file])
+        return self.c.exec_start(e['Id'])
+
+    def stats(self):
+        """
+        Summarize the transfer log, where each line is
+        `time|type|bytes|client|path`; type `I` is fetched from
+        upstream, `O` is sent to a client
+        """
+        res = dict(requests=0, misses=0, bytes_sent=0, bytes_fetched=0)
+        for line in self.read_log().splitlines():
+            fields = line.split('|')
+            if len(fields) < 3 or not fields[2].isdigit():
+                continue
+            if fields[1] == 'O':
+                res['requests'] += 1
+                res['bytes_sent'] += int(fields[2])
+            elif fields[1] == 'I':
+                res['misses'] += 1
+                res['bytes_fetched'] += int(fields[2])
+        res['hits'] = max(0, res['requests'] - res['misses'])
+        res['bytes_saved'] = max(0, res['bytes_sent'] - res['bytes_fetched'])
+        return res
+
+    def dump_stats(self):
+        if self.settings['url'] or self.container() is None:
+            sys.stderr.write("Error:  no managed package cache\n")
+            sys.exit(1)
+        s = self.stats()
+        mb = lambda b: b / 1048576.0
+        print "Package cache %s:" % self.proxy_url
+        print "    Requests:  %d (%d hits, %d misses; %.1f%% hit rate)" % \
+            (s['requests'], s['hits'], s['misses'],
+             100.0 * s['hits'] / s['requests'] if s['requests'] else 0)
+        print "    Sent:      %.1f MB" % mb(s['bytes_sent'])
+        print "    Fetched:   %.1f MB" % mb(s['bytes_fetched'])
+        print "    Saved:     %.1f MB" % mb(s['bytes_saved'])
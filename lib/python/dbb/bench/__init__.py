@@ -0,0 +1,8 @@
+# Benchmarks for dbb; see `bin/dbb-bench`
+
+def median(times):
+    """Median of a list of numbers, the mean of the middle two for an
+    even count"""
+    times = sorted(times)
+    mid = len(times) // 2
+    return times[mid] if len(times) % 2 else (times[mid - 1] + times[mid]) / 2.0
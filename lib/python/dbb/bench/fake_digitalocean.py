@@ -0,0 +1,82 @@
+# Fake DigitalOcean API, enough for droplet and image listings
+
+import json, urllib
+from dbb.bench.fake_server import handler, fake_server
+
+class digitalocean_state(object):
+    def __init__(self, droplets=500, images=300):
+        self.droplets = [ self.droplet(i) for i in range(1, droplets + 1) ]
+        self.images = [ dict(id = 1000 + i, name = 'image-%d' % i,
+                             distribution = 'Debian', public = False,
+                             regions = ['nyc3'])
+                        for i in range(images) ]
+
+    def droplet(self, droplet_id):
+        return dict(
+            id = droplet_id,
+            name = 'droplet-%d' % droplet_id,
+            status = 'active',
+            memory = 2048, vcpus = 2, disk = 40,
+            size_slug = '2gb',
+            created_at = '2016-01-01T00:00:00Z',
+            features = [],
+            networks = dict(
+                v4 = [ dict(ip_address = '10.0.%d.%d' % \
+                                (droplet_id // 256, droplet_id % 256),
+                            type = 'public') ],
+                v6 = []),
+            region = dict(slug = 'nyc3'),
+            image = dict(id = 1000),
+            )
+
+class digitalocean_handler(handler):
+    routes = [
+        ('GET', r'/v2/droplets/?', 'list_droplets'),
+        ('GET', r'/v2/droplets/(\d+)/?', 'get_droplet'),
+        ('DELETE', r'/v2/droplets/(\d+)/?', 'delete_droplet'),
+        ('GET', r'/v2/images/?', 'list_images'),
+        ]
+
+    def page(self, key, items):
+        """Send a page of `items`, with links as the API paginates"""
+        per_page = int(self.query.get('per_page', 20))
+        page = int(self.query.get('page', 1))
+        last = max(1, (len(items) + per_page - 1) // per_page)
+        query = dict(self.query, page = last)
+        self.send_json({
+                key : items[(page - 1) * per_page:page * per_page],
+                'links' : dict(pages = dict(
+                        last = '%s?%s' % (self.path.split('?')[0],
+                                          urllib.urlencode(query)))),
+                'meta' : dict(total = len(items)),
+                })
+
+    def list_droplets(self):
+        self.page('droplets', self.state.droplets)
+
+    def find_droplet(self, droplet_id):
+        return ([ d for d in self.state.droplets
+                  if d['id'] == int(droplet_id) ] + [None])[0]
+
+    def get_droplet(self, droplet_id):
+        droplet = self.find_droplet(droplet_id)
+        if droplet is None:
+            return self.send_json(dict(id = 'not_found',
+                                       message = 'not found'), 404)
+        self.send_json(dict(droplet = droplet))
+
+    def delete_droplet(self, droplet_id):
+        droplet = self.find_droplet(droplet_id)
+        if droplet is None:
+            return self.send_json(dict(id = 'not_found',
+                                       message = 'not found'), 404)
+        self.state.droplets.remove(droplet)
+        self.send_empty()
+
+    def list_images(self):
+        self.page('images', self.state.images)
+
+def fake_digitalocean(**kwargs):
+    """Start a fake DigitalOcean API; return the server"""
+    return fake_server(digitalocean_handler,
+                       digitalocean_state(**kwargs)).start()
@@ -0,0 +1,241 @@
+# Fake Docker Remote API, enough for dbb's operations
+
+import hashlib, json, re, struct, tarfile, time
+from StringIO import StringIO
+from dbb.bench.fake_server import handler, fake_server
+
+class docker_state(object):
+    """Images, containers and execs, seeded with `images` images and
+    `containers` stopped containers; builds stream `log_lines` lines;
+    requests for API versions above `api_version` are rejected"""
+
+    def __init__(self, images=2000, containers=2000, log_lines=20000,
+                 api_version='1.24'):
+        self.api_version = api_version
+        self.log_lines = log_lines
+        self.images = {}
+        self.tags = {}
+        self.containers = {}
+        self.execs = {}
+        self.serial = 0
+        for i in range(images):
+            # Every tenth image is an old shared base image
+            labels = { 'dbb.base' : 'seed' } if i % 10 == 0 else {}
+            self.add_image('seed-image-%d:latest' % i, labels)
+        for i in range(containers):
+            self.add_container('seed-container-%d' % i,
+                               dict(Image = 'seed-image-%d' % i))
+
+    def new_id(self):
+        self.serial += 1
+        return hashlib.sha256(str(self.serial)).hexdigest()
+
+    def add_image(self, tag, labels):
+        tag = self.full_tag(tag)
+        image_id = 'sha256:' + self.new_id()
+        old = self.image(tag)
+        if old is not None:
+            old['RepoTags'].remove(tag)
+        self.images[image_id] = dict(
+            Id = image_id,
+            RepoTags = [tag],
+            Created = int(time.time()),
+            Size = 500 * 1024 * 1024,
+            Config = dict(Labels = labels),
+            )
+        self.tags[tag] = image_id
+        return self.images[image_id]
+
+    def full_tag(self, name):
+        if ':' not in name.split('/')[-1]:
+            name += ':latest'
+        return name
+
+    def image(self, name):
+        return self.images.get(self.tags.get(self.full_tag(name), name))
+
+    def add_container(self, name, config):
+        self.containers[name] = dict(
+            Id = self.new_id(),
+            Name = '/' + name,
+            Config = dict(config, Tty = config.get('Tty', False)),
+            State = dict(Running = False, ExitCode = 0),
+            NetworkSettings = dict(IPAddress = ''),
+            )
+        return self.containers[name]
+
+class docker_handler(handler):
+    v = r'(?:/v[0-9.]+)?'
+
+    def dispatch(self):
+        m = re.match(r'/v([0-9.]+)/', self.path)
+        if m and self.version_tuple(m.group(1)) > \
+                self.version_tuple(self.server.state.api_version):
+            self.read_body()
+            return self.send_json(dict(message = \
+                    'client is newer than server (client API version: %s, '
+                    'server API version: %s)' % \
+                        (m.group(1), self.server.state.api_version)), 400)
+        handler.dispatch(self)
+
+    do_GET = do_POST = do_PUT = do_DELETE = dispatch
+
+    @staticmethod
+    def version_tuple(version):
+        return tuple([ int(v) for v in version.split('.') ])
+    routes = [
+        ('GET', v + r'/version', 'version'),
+        ('GET', v + r'/_ping', 'ping'),
+        ('GET', v + r'/info', 'info'),
+        ('GET', v + r'/images/json', 'images'),
+        ('GET', v + r'/images/(.+)/json', 'inspect_image'),
+        ('DELETE', v + r'/images/(.+)', 'remove_image'),
+        ('POST', v + r'/build', 'build'),
+        ('POST', v + r'/containers/create', 'create_container'),
+        ('GET', v + r'/containers/([^/]+)/json', 'inspect_container'),
+        ('POST', v + r'/containers/([^/]+)/start', 'start'),
+        ('POST', v + r'/containers/([^/]+)/stop', 'stop'),
+        ('GET', v + r'/containers/([^/]+)/logs', 'logs'),
+        ('DELETE', v + r'/containers/([^/]+)', 'remove_container'),
+        ('POST', v + r'/containers/([^/]+)/exec', 'exec_create'),
+        ('POST', v + r'/exec/([^/]+)/start', 'exec_start'),
+        ('GET', v + r'/exec/([^/]+)/json', 'exec_inspect'),
+        ]
+
+    def version(self):
+        self.send_json(dict(ApiVersion = self.state.api_version,
+                            Version = '1.12.6'))
+
+    def ping(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('OK')
+
+    def info(self):
+        self.send_json(dict(Images = len(self.state.images),
+                            Containers = len(self.state.containers)))
+
+    def images(self):
+        filters = json.loads(self.query.get('filters', '{}'))
+        labels = filters.get('label', [])
+        if not isinstance(labels, list):
+            labels = [labels]
+        res = []
+        for image in self.state.images.values():
+            image_labels = image['Config']['Labels'] or {}
+            if all([ l.split('=')[0] in image_labels for l in labels ]):
+                res.append(dict(Id = image['Id'],
+                                RepoTags = image['RepoTags'] or \
+                                    ['<none>:<none>'],
+                                Labels = image_labels))
+        self.send_json(res)
+
+    def inspect_image(self, name):
+        image = self.state.image(name)
+        if image is None:
+            return self.send_json(dict(message = 'no such image'), 404)
+        self.send_json(image)
+
+    def remove_image(self, name):
+        image = self.state.image(name)
+        if image is None:
+            return self.send_json(dict(message = 'no such image'), 404)
+        for tag in image['RepoTags']:
+            del self.state.tags[tag]
+        del self.state.images[image['Id']]
+        self.send_json([dict(Deleted = image['Id'])])
+
+    def build(self):
+        tarball = tarfile.open(fileobj=StringIO(self.body), mode='r:*')
+        dockerfile = tarball.extractfile('Dockerfile').read()
+        labels = dict(re.findall(r'^LABEL\s+(\S+?)="(.*)"$', dockerfile,
+                                 re.MULTILINE))
+        tag = self.query.get('t')
+        image = self.state.add_image(tag, labels)
+        steps = [ l for l in dockerfile.splitlines()
+                  if re.match(r'[A-Z]+\s', l) ]
+
+        def stream():
+            per_step = max(1, self.state.log_lines // max(1, len(steps)))
+            for n, step in enumerate(steps):
+                yield json.dumps(dict(stream = 'Step %d/%d : %s\n' % \
+                                          (n + 1, len(steps), step)))
+                lines = [ json.dumps(dict(stream = 'output line %d\n' % i))
+                          for i in range(per_step) ]
+                # Several events per chunk, as the daemon sends them
+                for i in range(0, len(lines), 50):
+                    yield '\r\n'.join(lines[i:i + 50]) + '\r\n'
+            yield json.dumps(dict(stream = 'Successfully built %s\n' % \
+                                      image['Id'][7:19]))
+        self.send_stream(stream())
+
+    def create_container(self):
+        name = self.query['name']
+        if name in self.state.containers:
+            return self.send_json(dict(message = 'name in use'), 409)
+        c = self.state.add_container(name, json.loads(self.body))
+        self.send_json(dict(Id = c['Id'], Warnings = None), 201)
+
+    def container(self, name):
+        c = self.state.containers.get(name)
+        if c is None:
+            self.send_json(dict(message = 'no such container'), 404)
+        return c
+
+    def inspect_container(self, name):
+        c = self.container(name)
+        if c is not None:
+            self.send_json(c)
+
+    def start(self, name):
+        c = self.container(name)
+        if c is not None:
+            c['State']['Running'] = True
+            c['NetworkSettings']['IPAddress'] = '127.0.0.1'
+            self.send_empty()
+
+    def stop(self, name):
+        c = self.container(name)
+        if c is not None:
+            c['State']['Running'] = False
+            self.send_empty()
+
+    def logs(self, name):
+        c = self.container(name)
+        if c is None:
+            return
+        if self.query.get('follow') in ('1', 'True', 'true'):
+            # A followed one-shot command runs to completion
+            c['State']['Running'] = False
+        self.send_raw([ 'log line %d\n' % i for i in range(100) ],
+                      'application/vnd.docker.raw-stream')
+
+    def remove_container(self, name):
+        c = self.container(name)
+        if c is None:
+            return
+        if c['State']['Running']:
+            return self.send_json(dict(message = 'container running'), 409)
+        del self.state.containers[name]
+        self.send_empty()
+
+    def exec_create(self, name):
+        if self.container(name) is None:
+            return
+        exec_id = self.state.new_id()
+        self.state.execs[exec_id] = dict(ExitCode = 0, Running = False)
+        self.send_json(dict(Id = exec_id), 201)
+
+    def exec_start(self, exec_id):
+        output = 'exec output\n' * 20
+        # Multiplexed stdout frame, as for a non-tty exec
+        self.send_raw([ struct.pack('>BxxxL', 1, len(output)) + output ],
+                      'application/vnd.docker.raw-stream')
+
+    def exec_inspect(self, exec_id):
+        self.send_json(self.state.execs[exec_id])
+
+def fake_docker(**kwargs):
+    """Start a fake Docker daemon; return the server"""
+    return fake_server(docker_handler, docker_state(**kwargs)).start()
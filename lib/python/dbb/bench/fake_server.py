@@ -0,0 +1,125 @@
+# Minimal threaded HTTP API server for fakes of remote APIs
+#
+# The server runs in a child process, so its memory and CPU don't
+# count against the benchmarked process.
+
+import BaseHTTPServer, SocketServer, json, multiprocessing, re, urllib
+import urlparse
+
+class server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Dispatch requests to methods by `routes`, a list of
+    `(http_method, path_regex, method_name)`; regex groups are passed
+    to the method, with the parsed query in `self.query`, the request
+    body in `self.body` and the fake's state in `self.state`
+
+    Requests are counted by method name, served at `/_fake/requests`
+    """
+    protocol_version = 'HTTP/1.1'
+    routes = []
+    # Send each response in as few packets as possible, or delayed
+    # ACKs would dominate the timings
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def dispatch(self):
+        self.body = self.read_body()
+        url = urlparse.urlparse(self.path)
+        self.query = dict(urlparse.parse_qsl(url.query))
+        self.state = self.server.state
+        path = urllib.unquote(url.path)
+        if path == '/_fake/requests':
+            return self.send_json(self.server.requests)
+        for method, pattern, name in self.routes:
+            m = re.match(pattern + '$', path)
+            if method == self.command and m:
+                self.server.requests[name] = \
+                    self.server.requests.get(name, 0) + 1
+                return getattr(self, name)(*m.groups())
+        self.send_json(dict(message = 'no route for %s %s' % \
+                                (self.command, path)), 404)
+
+    do_GET = do_POST = do_PUT = do_DELETE = dispatch
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '') == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return ''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, status=204):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_stream(self, chunks, content_type='application/json'):
+        """Send an iterable of strings as a chunked response"""
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for chunk in chunks:
+            if chunk:
+                self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+        self.wfile.write('0\r\n\r\n')
+
+    def send_raw(self, chunks, content_type):
+        """Send an iterable of strings on the connection, then close
+        it, as for a hijacked connection"""
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        for chunk in chunks:
+            self.wfile.write(chunk)
+        self.close_connection = 1
+
+class fake_server(object):
+    """Serve a fake API with `handler_class` and `state` on a local
+    port"""
+    def __init__(self, handler_class, state):
+        self.httpd = server(('127.0.0.1', 0), handler_class)
+        self.httpd.state = state
+        self.httpd.requests = {}
+        self.port = self.httpd.server_address[1]
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.port
+
+    def requests(self):
+        """Number of requests served so far, by handler method"""
+        return json.load(urllib.urlopen(self.url + '/_fake/requests'))
+
+    def start(self):
+        self.process = multiprocessing.Process(
+            target=self.httpd.serve_forever)
+        self.process.daemon = True
+        self.process.start()
+        self.httpd.socket.close()
+        return self
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
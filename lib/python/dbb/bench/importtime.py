@@ -0,0 +1,42 @@
+# Run a script with an import tracer, similar to Python 3's
+# `python -X importtime`:
+#
+#     python importtime.py OUTPUT.json SCRIPT [ARGS...]
+#
+# Writes a JSON list of `[module, depth, self_secs, cumulative_secs]`
+# for each import that loaded new modules, in load order.  This
+# module must not import anything from dbb, or that would escape the
+# trace.
+
+import __builtin__, atexit, json, sys, time
+
+records = []
+stack = []
+real_import = __builtin__.__import__
+
+def traced_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    loaded = len(sys.modules)
+    stack.append(0.0)
+    start = time.time()
+    try:
+        return real_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.time() - start
+        children = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        if len(sys.modules) > loaded:
+            records.append([name, len(stack), elapsed - children, elapsed])
+
+def dump(output):
+    __builtin__.__import__ = real_import
+    with open(output, 'w') as f:
+        json.dump(records, f)
+
+if __name__ == '__main__':
+    output, script = sys.argv[1:3]
+    sys.argv = sys.argv[2:]
+    sys.path[0] = __import__('os').path.dirname(script)
+    atexit.register(dump, output)
+    __builtin__.__import__ = traced_import
+    execfile(script, dict(__name__ = '__main__', __file__ = script))
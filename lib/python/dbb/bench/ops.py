@@ -0,0 +1,288 @@
+# End-to-end benchmarks of dbb operations against fake remote APIs
+
+import json, os, platform, resource, shutil, subprocess, sys, tempfile, time
+import yaml
+from dbb.bench import median
+from dbb.bench.fake_docker import fake_docker
+from dbb.bench.fake_digitalocean import fake_digitalocean
+from dbb.config import config
+from dbb.cli import cli
+
+class quiet(object):
+    """Discard stdout and stderr"""
+    def __enter__(self):
+        self.saved = (sys.stdout, sys.stderr)
+        sys.stdout = sys.stderr = open(os.devnull, 'w')
+
+    def __exit__(self, *exc):
+        sys.stdout.close()
+        sys.stdout, sys.stderr = self.saved
+
+def rss():
+    """Current resident set size of this process in kB"""
+    with open('/proc/self/statm', 'r') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() // 1024
+
+class ops(object):
+    """
+    Time dbb operations, in this process, on a generated config with
+    `slaves` slaves, against a fake Docker daemon seeded with `images`
+    images and `containers` containers whose builds stream `log_lines`
+    lines of output, and a fake DigitalOcean API with `droplets`
+    droplets.  Each result has the min, median and max seconds over
+    `runs` runs, the largest growth in the process's resident memory
+    over a run, and its resident memory afterwards.
+    """
+    base_images = ['debian:jessie', 'debian:wheezy',
+                   'armbuild/debian:jessie', 'ubuntu:trusty']
+
+    def __init__(self, topdir, runs=5, slaves=200, images=2000,
+                 containers=2000, log_lines=20000, droplets=500):
+        self.topdir = topdir
+        self.runs = runs
+        self.slaves = slaves
+        self.images = images
+        self.containers = containers
+        self.log_lines = log_lines
+        self.droplets = droplets
+        self.results = {}
+
+    @property
+    def sizes(self):
+        return dict(slaves = self.slaves, images = self.images,
+                    containers = self.containers, log_lines = self.log_lines,
+                    droplets = self.droplets)
+
+    def setup(self):
+        """Generate a tree with a large config, sharing this tree's lib"""
+        self.tree = tempfile.mkdtemp(prefix='dbb-bench-')
+        os.symlink(os.path.join(self.topdir, 'lib'),
+                   os.path.join(self.tree, 'lib'))
+        with open(os.path.join(self.topdir, 'config.sample.yaml'), 'r') as f:
+            conf = yaml.safe_load(f)
+        conf['slaves'] = {}
+        for i in range(self.slaves):
+            conf['slaves']['bench-%03d' % i] = dict(
+                base_image = self.base_images[i % len(self.base_images)],
+                password = 'password-%d' % i,
+                host = 'host-%d' % (i // 4),
+                flavors = ['posix', 'rt-preempt'] if i % 3 else ['posix'],
+                parallel_jobs = 4,
+                )
+        self.host = 'bench-000'
+        conf.update(git_repo = 'https://example.com/machinekit.git',
+                    master_name = self.host, master_host = self.host,
+                    digitalocean = dict(token = 'bench'))
+        self.config_file = os.path.join(self.tree, 'config.yaml')
+        with open(self.config_file, 'w') as f:
+            yaml.safe_dump(conf, f, default_flow_style=False)
+
+        self.docker = fake_docker(images=self.images,
+                                  containers=self.containers,
+                                  log_lines=self.log_lines)
+        for var in ('DOCKER_TLS_VERIFY', 'DOCKER_CERT_PATH'):
+            os.environ.pop(var, None)
+        os.environ['DOCKER_HOST'] = 'tcp://127.0.0.1:%d' % self.docker.port
+
+    def teardown(self):
+        self.docker.stop()
+        shutil.rmtree(self.tree)
+
+    def record(self, name, runs):
+        """Record `(seconds, status, rss growth in kB)` for each run"""
+        times = sorted([ r[0] for r in runs ])
+        self.results[name] = dict(
+            runs = len(times),
+            min = times[0],
+            median = median(times),
+            max = times[-1],
+            rss_growth_kb = max([ r[2] for r in runs ]),
+            rss_kb = rss(),
+            status = ([ r[1] for r in runs if r[1] ] + [0])[0],
+            )
+
+    def run_once(self, operation):
+        """Run `operation()`; return `(seconds, status, rss growth)`"""
+        status = 0
+        with quiet():
+            before = rss()
+            start = time.time()
+            try:
+                operation()
+            except SystemExit as e:
+                status = e.code
+            elapsed = time.time() - start
+        return (elapsed, status, rss() - before)
+
+    def measure(self, name, operation, before=None, runs=None):
+        """Time `operation()` over runs, calling `before()` untimed
+        before each"""
+        res = []
+        for i in range(runs or self.runs):
+            if before is not None:
+                before()
+            res.append(self.run_once(operation))
+        self.record(name, res)
+
+    def dbb(self, *args):
+        """Return a function running a dbb command line in process"""
+        argv = ['-c', self.config_file, '-H', self.host] + list(args)
+        return lambda: cli(self.tree, argv).doit()
+
+    def forget_config(self):
+        config._loaded.clear()
+
+    def forget_config_cache(self):
+        self.forget_config()
+        cache = os.path.join(self.tree, '.config.yaml.pickle')
+        if os.path.exists(cache):
+            os.unlink(cache)
+
+    def bench_config(self):
+        self.measure('config load (parse)',
+                     lambda: config(self.config_file, self.host),
+                     before=self.forget_config_cache)
+        self.measure('config load (pickle cache)',
+                     lambda: config(self.config_file, self.host),
+                     before=self.forget_config)
+        self.measure('config load (in process)',
+                     lambda: config(self.config_file, self.host))
+        self.measure('config build matrix',
+                     lambda: config(self.config_file, self.host).build_matrix())
+
+    def bench_context(self):
+        from dbb.docker_context import docker_context
+        c = config(self.config_file, self.host)
+        self.measure('template render',
+                     lambda: str(docker_context(c).dockerfile))
+        self.measure('context hash',
+                     lambda: docker_context(c).hash())
+        self.measure('context file',
+                     lambda: docker_context(c).file(
+                dict(label = 'value')).read())
+
+    def bench_container(self):
+        self.measure('--build', self.dbb('--build', '--force'))
+        self.measure('--build (up to date)', self.dbb('--build'))
+        self.measure('--init (one-shot container)', self.dbb('--init'))
+
+        # Container lifecycle, each step timed separately
+        steps = [ ('--run', self.dbb('--run')),
+                  ('--init (exec)', self.dbb('--init')),
+                  ('--stop', self.dbb('--stop')),
+                  ('--remove', self.dbb('--remove')) ]
+        res = dict([ (name, []) for name, op in steps ])
+        for i in range(self.runs):
+            for name, operation in steps:
+                res[name].append(self.run_once(operation))
+        for name, op in steps:
+            self.record(name, res[name])
+
+        self.measure('--dump-container', self.dbb('--dump-container'))
+        # Removes the seeded base images, so only once
+        self.measure('--gc-base', self.dbb('--gc-base'), runs=1)
+
+    def bench_digitalocean(self):
+        try:
+            import digitalocean
+            from digitalocean_buildslave import DropletIndex
+        except ImportError as e:
+            sys.stderr.write("Skipping DigitalOcean benchmarks:  %s\n" % e)
+            return
+        server = fake_digitalocean(droplets=self.droplets)
+        # python-digitalocean hard-codes the API URL in each object
+        base_init = digitalocean.baseapi.BaseAPI.__init__
+        def init(api, *args, **kwargs):
+            base_init(api, *args, **kwargs)
+            api.end_point = server.url + '/v2/'
+        digitalocean.baseapi.BaseAPI.__init__ = init
+        try:
+            last = 'droplet-%d' % self.droplets
+            self.measure('droplet index (cold)',
+                         lambda: DropletIndex('bench').droplet_by_name(last))
+            index = DropletIndex('bench')
+            index.droplet_by_name(last)
+            self.measure('droplet index (cached)',
+                         lambda: index.droplet_by_name(last))
+            self.measure('droplet by ID',
+                         lambda: index.droplet_by_id(self.droplets))
+            self.measure('image ID (cold)',
+                         lambda: DropletIndex('bench').image_id('image-1'))
+        finally:
+            digitalocean.baseapi.BaseAPI.__init__ = base_init
+            server.stop()
+
+    def run(self):
+        self.setup()
+        try:
+            self.bench_config()
+            self.bench_context()
+            self.bench_container()
+            self.bench_digitalocean()
+        finally:
+            self.teardown()
+        return self.results
+
+    def report(self, out=sys.stdout):
+        out.write("%-30s %9s %9s %9s %9s %9s %6s\n" % \
+                      ('OPERATION', 'MIN', 'MEDIAN', 'MAX', 'RSS+',
+                       'RSS', 'STATUS'))
+        for name in sorted(self.results):
+            r = self.results[name]
+            out.write("%-30s %7.1fms %7.1fms %7.1fms %+7.1fMB %7.1fMB %6s\n" % \
+                          (name, r['min'] * 1000, r['median'] * 1000,
+                           r['max'] * 1000, r['rss_growth_kb'] / 1024.0,
+                           r['rss_kb'] / 1024.0, r['status']))
+
+def metadata(topdir):
+    """Where and when results were taken"""
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=topdir,
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(commit = commit, python = platform.python_version(),
+                host = platform.node(), time = time.time())
+
+def timings(results):
+    """Flatten saved results to a map of names to (min, median)
+    seconds"""
+    res = {}
+    for r in results.get('startup', []):
+        res['startup %s' % r['command']] = (r['min'], r['median'])
+    for name, r in results.get('ops', {}).items():
+        res[name] = (r['min'], r['median'])
+    return res
+
+def compare(old, new, threshold=0.1, min_delta=0.001, out=sys.stdout):
+    """
+    Compare medians of two saved results; return the number of
+    operations more than `threshold` (a fraction) and `min_delta`
+    seconds slower, whose fastest new run is also slower than the old
+    median, so a single slow run isn't a regression
+
+    Results of `--ops` runs with different sizes aren't comparable.
+    """
+    if 'ops' in old and 'ops' in new and \
+            old.get('sizes') != new.get('sizes'):
+        sys.stderr.write("Error:  can't compare results with different "
+                         "sizes:  %s vs. %s\n" % \
+                             (old.get('sizes'), new.get('sizes')))
+        sys.exit(1)
+    old, new = timings(old), timings(new)
+    regressions = 0
+    out.write("%-40s %9s %9s %8s\n" % ('OPERATION', 'OLD', 'NEW', 'CHANGE'))
+    for name in sorted(set(old) & set(new)):
+        old_median = old[name][1]
+        new_min, new_median = new[name]
+        change = (new_median - old_median) / old_median if old_median else 0
+        flag = ''
+        if change > threshold and new_median - old_median > min_delta \
+                and new_min > old_median:
+            flag = '  REGRESSION'
+            regressions += 1
+        out.write("%-40s %7.1fms %7.1fms %+7.0f%%%s\n" % \
+                      (name, old_median * 1000, new_median * 1000,
+                       change * 100, flag))
+    return regressions
@@ -0,0 +1,94 @@
+# Startup time benchmark for `bin/dbb` subcommands
+
+import json, os, subprocess, sys, tempfile, time
+from dbb.bench import median
+
+# Subcommands that run without a Docker daemon
+default_commands = [
+    '--help',
+    '--dump-config',
+    '--dump-dockerfile',
+    '--dump-deb-control',
+    '--check-templates',
+    '--dump-context',
+    ]
+
+# Modules that shouldn't be needed just to read the config
+heavy_modules = ['docker', 'dockerpty', 'requests', 'tarfile', 'gzip']
+
+class startup(object):
+    """
+    Time `bin/dbb` cold starts for each subcommand:  wall time over
+    several runs, and with an import tracer, what was imported and
+    what it cost
+    """
+    def __init__(self, topdir, args=[], runs=5, top=10):
+        self.topdir = topdir
+        self.dbb = os.path.join(topdir, 'bin', 'dbb')
+        self.args = args
+        self.runs = runs
+        self.top = top
+
+    def command(self, subcommand):
+        return [sys.executable, self.dbb] + self.args + subcommand.split()
+
+    def wall_times(self, subcommand):
+        res = []
+        with open(os.devnull, 'w') as devnull:
+            for i in range(self.runs):
+                start = time.time()
+                status = subprocess.call(self.command(subcommand),
+                                         stdout=devnull, stderr=devnull)
+                res.append(time.time() - start)
+        return status, sorted(res)
+
+    def import_times(self, subcommand):
+        tracer = os.path.join(os.path.dirname(__file__), 'importtime.py')
+        fd, output = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            with open(os.devnull, 'w') as devnull:
+                subprocess.call(
+                    [sys.executable, tracer, output] + \
+                        self.command(subcommand)[1:],
+                    stdout=devnull, stderr=devnull)
+            with open(output, 'r') as f:
+                return json.load(f)
+        finally:
+            os.unlink(output)
+
+    def measure(self, subcommand):
+        status, times = self.wall_times(subcommand)
+        imports = self.import_times(subcommand)
+        names = set([ r[0].split('.')[0] for r in imports ])
+        return dict(
+            command = subcommand,
+            status = status,
+            min = times[0],
+            median = median(times),
+            max = times[-1],
+            imports = len(imports),
+            import_time = sum([ r[2] for r in imports ]),
+            heavy = [ m for m in heavy_modules if m in names ],
+            slowest = sorted(imports, key=lambda r: -r[2])[:self.top],
+            )
+
+    def run(self, subcommands=None):
+        return [ self.measure(s) for s in subcommands or default_commands ]
+
+    def report(self, results, out=sys.stdout):
+        out.write("%-22s %8s %8s %8s %7s  %s\n" % \
+                      ('COMMAND', 'MIN', 'MEDIAN', 'IMPORT', 'STATUS',
+                       'HEAVY MODULES'))
+        for r in results:
+            out.write("%-22s %7.0fms %7.0fms %7.0fms %7d  %s\n" % \
+                          (r['command'], r['min'] * 1000, r['median'] * 1000,
+                           r['import_time'] * 1000, r['status'],
+                           ', '.join(r['heavy']) or '-'))
+        for r in results:
+            out.write("\n%s:  slowest imports (self, cumulative)\n" % \
+                          r['command'])
+            for name, depth, self_time, cumulative in r['slowest']:
+                out.write("    %7.1fms %7.1fms  %s%s\n" % \
+                              (self_time * 1000, cumulative * 1000,
+                               '  ' * depth, name))
@@ -0,0 +1,84 @@
+import sys, json
+
+class build_log(object):
+    """
+    Incremental decoder for the Docker daemon's JSON build output
+    stream
+
+    Chunks from the daemon may split or join JSON messages; complete
+    messages are decoded as they arrive and turned into events, dicts
+    with a `type` of `step`, `stream`, `progress` or `error`.
+    """
+    decoder = json.JSONDecoder()
+
+    def __init__(self, log_format='plain', out=None):
+        self.log_format = log_format
+        self.out = out or sys.stdout
+        self.buf = ''
+
+    def feed(self, chunk):
+        """Add a chunk of daemon output; return list of complete events"""
+        self.buf += chunk
+        events = []
+        pos = 0
+        while True:
+            # Skip whitespace between messages
+            while pos < len(self.buf) and self.buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos == len(self.buf):
+                break
+            try:
+                msg, pos = self.decoder.raw_decode(self.buf, pos)
+            except ValueError:
+                # Incomplete message; wait for the next chunk
+                break
+            events.append(self.event(msg))
+        self.buf = self.buf[pos:]
+        return events
+
+    def close(self):
+        """End of stream; return an error event for any undecoded data"""
+        if self.buf.strip():
+            return [dict(type='error',
+                         message='Undecodable daemon output:  %r' % self.buf)]
+        return []
+
+    def event(self, msg):
+        """Convert one daemon message to an event"""
+        if 'errorDetail' in msg or 'error' in msg:
+            detail = msg.get('errorDetail') or {}
+            return dict(type='error',
+                        message=detail.get('message', msg.get('error')),
+                        code=detail.get('code'))
+        if 'stream' in msg:
+            text = msg['stream']
+            if text.startswith('Step '):
+                return dict(type='step', text=text)
+            return dict(type='stream', text=text)
+        if 'status' in msg:
+            detail = msg.get('progressDetail') or {}
+            return dict(type='progress', id=msg.get('id'),
+                        status=msg['status'],
+                        current=detail.get('current'),
+                        total=detail.get('total'))
+        return dict(type='other', message=msg)
+
+    def write(self, event):
+        """Write an event to the output in the configured format"""
+        if self.log_format == 'json':
+            self.out.write(json.dumps(event, sort_keys=True) + '\n')
+        elif event['type'] in ('step', 'stream'):
+            self.out.write(event['text'].encode('utf-8'))
+        elif event['type'] == 'progress' and event['current'] is None:
+            # Skip intermediate progress bar updates
+            self.out.write(('%s%s\n' % (
+                        event['id'] and '%s: ' % event['id'] or '',
+                        event['status'])).encode('utf-8'))
+
+    def events(self, stream):
+        """Generate events from an iterable of daemon output chunks"""
+        for chunk in stream:
+            for event in self.feed(chunk):
+                yield event
+        for event in self.close():
+            yield event
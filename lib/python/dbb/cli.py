@@ -1,31 +1,71 @@
-import argparse, os
+import argparse, os, sys, shlex, time
 from dbb.config import config
-from dbb.container import container
+# Other dbb modules, and the docker module they pull in, are imported
+# only by the operations that need them, to keep startup fast
 
 class cli(object):
-    def __init__(self, topdir):
-        self.parse()
+    def __init__(self, topdir, argv=None):
+        self.topdir = topdir
+        self.parse(argv)
+        self.setup()
+
+    def setup(self):
+        """Load the config and pick hosts for the parsed args"""
         if not os.path.exists(self.args.config_file):
-            c = os.path.join(topdir, self.args.config_file)
+            c = os.path.join(self.topdir, self.args.config_file)
             if os.path.exists(c):
                 self.args.config_file = c
             else:
                 raise RuntimeError("Unable to locate config, '%s'" % \
                                        self.args.config_file)
-        self.config = config(self.args.config_file, self.args.docker_hostname)
+        hosts = self.args.docker_hostname or []
+        self.config = config(self.args.config_file, (hosts + [None])[0])
+        if self.args.all_hosts:
+            hosts = sorted(self.config.slaves)
+        self.hosts = hosts
+        if hasattr(self, '_docker'):
+            del self._docker
+
+    def parse(self, argv=None):
+        if not hasattr(self, 'parser'):
+            self.make_parser()
+        self.args = self.parser.parse_args(argv)
 
-    def parse(self):
+    def make_parser(self):
         self.parser = argparse.ArgumentParser(
             description='Manage Buildbot in Docker')
         cmdgroup = self.parser.add_mutually_exclusive_group(
             required=True)
         # configuration args
         self.parser.add_argument("--docker-hostname", "-H",
-                                 help="Container host name")
+                                 action="append",
+                                 help="Container host name (may be repeated)")
+        self.parser.add_argument("--all-hosts", "-a", action="store_true",
+                                 help="Operate on all hosts in the " \
+                                     "config file's slaves list")
+        self.parser.add_argument("--jobs", "-j", type=int, default=4,
+                                 help="Number of hosts to operate on " \
+                                     "in parallel (default 4)")
         self.parser.add_argument("--config-file", "-c",
                                  default="config.yaml",
                                  help="YAML configuration file")
+        self.parser.add_argument("--force", action="store_true",
+                                 help="With --build, rebuild even if " \
+                                     "the image is up to date")
+        self.parser.add_argument("--log-format", default="plain",
+                                 choices=["plain", "json"],
+                                 help="With --build, output format of " \
+                                     "build log (default plain)")
+        self.parser.add_argument("--wait", action="store_true",
+                                 help="With --run, wait until buildbot " \
+                                     "and sshd are up")
+        self.parser.add_argument("--wait-timeout", type=int, default=60,
+                                 help="With --wait, seconds to wait " \
+                                     "(default 60)")
         # main operations
+        cmdgroup.add_argument("--batch", metavar="FILE",
+                              help="Run operations from FILE, one " \
+                                  "command line per line, in one process")
         cmdgroup.add_argument("--build", action="store_true",
                               help="Build container")
         cmdgroup.add_argument("--init", action="store_true",
@@ -33,56 +73,187 @@ class cli(object):
                                   "(idempotent)")
         cmdgroup.add_argument("--run", action="store_true",
                               help="Run container")
+        cmdgroup.add_argument("--gc-base", action="store_true",
+                              help="Remove unused shared base images")
         cmdgroup.add_argument("--attach", action="store_true",
                               help="Attach container")
         cmdgroup.add_argument("--stop", action="store_true",
                               help="Stop container")
         cmdgroup.add_argument("--remove", action="store_true",
                               help="Remove container (must be stopped)")
+        # package cache
+        cmdgroup.add_argument("--git-mirror", action="store_true",
+                              help="Create or refresh the shared git mirror")
+        cmdgroup.add_argument("--stats", action="store_true",
+                              help="Summarize build farm metrics from " \
+                                  "the master")
+        cmdgroup.add_argument("--cache-start", action="store_true",
+                              help="Start package cache container")
+        cmdgroup.add_argument("--cache-stop", action="store_true",
+                              help="Stop package cache container")
+        cmdgroup.add_argument("--cache-stats", action="store_true",
+                              help="Show package cache hit/miss statistics")
         # debug
         cmdgroup.add_argument("--dump-config", action="store_true",
                               help="Dump configuration")
         cmdgroup.add_argument("--dump-dockerfile", action="store_true",
                               help="Dump Dockerfile")
+        cmdgroup.add_argument("--dump-base-dockerfile", action="store_true",
+                              help="Dump shared base image Dockerfile")
         cmdgroup.add_argument("--dump-deb-control", action="store_true",
                               help="Dump Debian control file")
+        cmdgroup.add_argument("--check-templates", action="store_true",
+                              help="Check template substitution keys")
         cmdgroup.add_argument("--dump-context", action="store_true",
                               help="Dump Docker context as tarball")
         cmdgroup.add_argument("--dump-container", action="store_true",
                               help="Dump container info")
 
-        self.args = self.parser.parse_args()
+    # Operations that may run across multiple hosts
+    multi_host_ops = dict(
+        build = lambda self, d: d.build(force=self.args.force,
+                                        log_format=self.args.log_format),
+        run = lambda self, d: d.run(wait=self.args.wait,
+                                    wait_timeout=self.args.wait_timeout),
+        stop = lambda self, d: d.stop(),
+        remove = lambda self, d: d.remove(),
+        )
+
+    def doit_multi(self):
+        ops = [ op for op in self.multi_host_ops if getattr(self.args, op) ]
+        if not ops:
+            self.parser.error("Multiple hosts only supported with " \
+                                  "--build, --run, --stop or --remove")
+        from dbb.parallel import parallel
+        operation = self.multi_host_ops[ops[0]]
+        failed = parallel(self.config, self.hosts, self.args.jobs).run(
+            lambda d: operation(self, d))
+        if failed:
+            sys.exit(1)
+
+    def doit_batch(self):
+        """
+        Run each line of the batch file as a command line, sharing the
+        parsed config and Docker client; exit non-zero if any failed
+        """
+        with open(self.args.batch, 'r') as f:
+            lines = f.readlines()
+        # Lines default to the batch's config file
+        self.parser.set_defaults(config_file=self.args.config_file)
+        results = []
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            sys.stderr.write("*** %s\n" % line)
+            start = time.time()
+            status = 0
+            try:
+                self.parse(shlex.split(line))
+                if self.args.batch:
+                    self.parser.error("--batch may not be nested")
+                self.setup()
+                self.doit()
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) \
+                    else int(bool(e.code))
+            except Exception as e:
+                sys.stderr.write("Error:  %s\n" % e)
+                status = 1
+            results.append((line, status, time.time() - start))
+
+        sys.stderr.write("\n%-6s %8s  %s\n" % ('STATUS', 'TIME', 'COMMAND'))
+        for line, status, elapsed in results:
+            sys.stderr.write("%-6s %7.1fs  %s\n" % \
+                                 ('ok' if status == 0 else 'FAILED',
+                                  elapsed, line))
+        if [ r for r in results if r[1] != 0 ]:
+            sys.exit(1)
 
     def doit(self):
+        if self.args.batch:
+            self.doit_batch()
+            return
+        if len(self.hosts) > 1 or self.args.all_hosts:
+            self.doit_multi()
+            return
+
         # main operations
         if self.args.build:
-            self.docker.build()
+            self.docker.build(force=self.args.force,
+                              log_format=self.args.log_format)
         if self.args.init:
-            self.docker.init()
+            if os.environ.get('CONTAINER', None) == 'docker-bb':
+                # In the container; no Docker API needed
+                from dbb.init import init
+                init(self.config).init()
+            else:
+                self.docker.init()
         if self.args.run:
-            self.docker.run()
+            self.docker.run(wait=self.args.wait,
+                            wait_timeout=self.args.wait_timeout)
+        if self.args.gc_base:
+            self.docker.gc_base()
         if self.args.attach:
             self.docker.attach()
         if self.args.stop:
             self.docker.stop()
         if self.args.remove:
             self.docker.remove()
+        if self.args.git_mirror:
+            from dbb.git_mirror import git_mirror
+            git_mirror(self.config).refresh()
+        if self.args.stats:
+            self.stats()
+        # package cache
+        if self.args.cache_start:
+            self.docker.apt_cache.start()
+        if self.args.cache_stop:
+            self.docker.apt_cache.stop()
+        if self.args.cache_stats:
+            self.docker.apt_cache.dump_stats()
         # debug
         if self.args.dump_config:
             self.config.dump()
         if self.args.dump_dockerfile:
-            self.docker.context.dockerfile.dump()
+            from dbb.dockerfile import dockerfile
+            dockerfile(self.config).dump()
+        if self.args.dump_base_dockerfile:
+            from dbb.dockerfile import base_dockerfile
+            base_dockerfile(self.config).dump()
         if self.args.dump_deb_control:
-            self.docker.context.deb_control.dump()
+            from dbb.deb_control import deb_control
+            deb_control(self.config).dump()
+        if self.args.check_templates:
+            if not self.context.check():
+                sys.exit(1)
         if self.args.dump_context:
-            self.docker.context.dump()
+            self.context.dump()
         if self.args.dump_container:
             self.docker.dump()
 
+    def stats(self):
+        import urllib2
+        from dbb.metrics import parse, summary
+        try:
+            text = urllib2.urlopen(self.config.metrics_url, timeout=10).read()
+        except (urllib2.URLError, IOError) as e:
+            sys.stderr.write("Error:  reading metrics from %s:  %s\n" % \
+                                 (self.config.metrics_url, e))
+            sys.exit(1)
+        summary(parse(text), sys.stdout)
+
+    @property
+    def context(self):
+        """Docker build context, without a container object"""
+        from dbb.docker_context import docker_context
+        return docker_context(self.config)
+
     @property
     def docker(self):
         # Instantiate container on demand
         if not hasattr(self, '_docker'):
+            from dbb.container import container
             self._docker = container(self.config)
 
         return self._docker
@@ -0,0 +1,81 @@
+# Shared Docker client
+#
+# One client per daemon URL is shared by everything in the process, so
+# connections are pooled across operations; the daemon's API version
+# is cached on disk to skip version negotiation on later runs.
+
+import docker
+import json, os, re, threading
+
+_clients = {}
+_lock = threading.Lock()
+
+def client_kwargs():
+    """Client connection args from the `DOCKER_HOST`, etc. environment"""
+    kwargs = docker.utils.kwargs_from_env()
+    kwargs.setdefault('base_url', 'unix://var/run/docker.sock')
+    return kwargs
+
+def read_versions(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def write_version(path, base_url, version):
+    """Record a daemon's API version in the cache file at `path`"""
+    versions = read_versions(path)
+    versions[base_url] = version
+    try:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(versions, f, indent=2, sort_keys=True)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError):
+        pass  # Read-only tree; just don't cache
+
+class versioned_client(docker.Client):
+    """
+    Docker client starting from a cached API version; if the daemon
+    rejects it, e.g. after a daemon upgrade or downgrade, the version
+    is negotiated again, recorded in the cache and the request retried
+    """
+    version_mismatch = re.compile(
+        r'client is newer than server|client version \S+ is too (new|old)')
+
+    def __init__(self, version_file, env_base_url, **kwargs):
+        self.version_file = version_file
+        self.env_base_url = env_base_url
+        docker.Client.__init__(self, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        res = docker.Client.request(self, method, url, **kwargs)
+        version = getattr(self, '_version', None)  # None while negotiating
+        prefix = '%s/v%s/' % (self.base_url, version)
+        if version is None or res.status_code not in (400, 404, 500) or \
+                not url.startswith(prefix) or \
+                not self.version_mismatch.search(res.content):
+            return res
+        self._version = self._retrieve_server_version()
+        write_version(self.version_file, self.env_base_url, self._version)
+        if hasattr(kwargs.get('data', None), 'seek'):
+            kwargs['data'].seek(0)  # Resend a file body from the start
+        url = '%s/v%s/%s' % (self.base_url, self._version, url[len(prefix):])
+        return docker.Client.request(self, method, url, **kwargs)
+
+def client(config):
+    """Return the shared Docker client for the configured daemon"""
+    kwargs = client_kwargs()
+    base_url = kwargs['base_url']
+    with _lock:
+        if base_url not in _clients:
+            path = config.docker_api_version_file
+            version = read_versions(path).get(base_url)
+            c = versioned_client(path, base_url,
+                                 version=version or 'auto', **kwargs)
+            if version is None:
+                write_version(path, base_url, c.api_version)
+            _clients[base_url] = c
+        return _clients[base_url]
@@ -1,4 +1,6 @@
-import socket, yaml, os, subprocess
+import socket, os, re, subprocess, copy, hashlib
+import cPickle as pickle
+from dbb.template import compiled_template
 
 class AbstractSlaveConfig(object):
     global_config = None
@@ -11,6 +13,8 @@ class AbstractSlaveConfig(object):
         def __new__(meta, name, bases, dct):
             cls = type.__new__(meta, name, bases, dct)
             meta.__child_classes__.append(cls)
+            if dct.get('slave_class_name', None) is not None:
+                cls.type_map[cls.slave_class_name] = cls
             return cls
 
     def __init__(self, slave_name=None):
@@ -21,33 +25,47 @@ class AbstractSlaveConfig(object):
 
     @classmethod
     def get_slave_config(cls, slave_name=None):
+        """Return the slave config object, shared per slave name"""
         if slave_name is None:
             slave_name = cls.get_slave_name_by_host()
-        slave_params = cls.global_config.config['slaves'][slave_name]
-        slave_type = slave_params.get('slave_type', 'vanilla')
-        slave_config_cls = ([ c for c in cls.__child_classes__ \
-                              if c.slave_class_name == slave_type ] \
-                            + [None])[0]
-        if slave_config_cls is None:
-            raise RuntimeError('Unable to find slave class for "%s"' %
-                               slave_type)
-        return slave_config_cls(slave_name)
+        slave_configs = cls.global_config.slave_configs
+        if slave_name not in slave_configs:
+            slave_params = cls.global_config.config['slaves'][slave_name]
+            slave_type = slave_params.get('slave_type', 'vanilla')
+            slave_config_cls = cls.type_map.get(slave_type, None)
+            if slave_config_cls is None:
+                raise RuntimeError('Unable to find slave class for "%s"' %
+                                   slave_type)
+            slave_configs[slave_name] = slave_config_cls(slave_name)
+        return slave_configs[slave_name]
 
     @classmethod
-    def get_slave_name_by_host(cls):
+    def host_slave_names(cls):
+        """
+        Names of the slaves on this host, by hostname; a claimed
+        DigitalOcean pool droplet's slave is found from its tags
+        """
         h = socket.gethostname()
-        for (name, params) in cls.global_config.config['slaves'].items():
-            if params['host'] == h:
-                return name
-        raise RuntimeError('Unable to find slave from hostname "%s"' % h)
+        names = cls.global_config.host_index.get(h, [])
+        if not names and DigitalOceanSlaveConfig.is_pool_droplet(h):
+            name = DigitalOceanSlaveConfig.get_slave_name_by_droplet_tag()
+            names = [name] if name is not None else []
+        return names
+
+    @classmethod
+    def get_slave_name_by_host(cls):
+        names = cls.host_slave_names()
+        if not names:
+            raise RuntimeError('Unable to find slave from hostname "%s"' % \
+                                   socket.gethostname())
+        return names[0]
 
     @property
     def slave_dict(self):
         return self.global_config.config.get('slaves',{})
 
     def builder_slaves(self, builder):
-        return [ s for s in self.slave_dict \
-                 if self.slave_dict[s].get('builders', None) == builder ]
+        return self.global_config.builder_index.get(builder, [])
 
     @property
     def host(self):
@@ -74,13 +92,30 @@ class AbstractSlaveConfig(object):
         """Password for this slave"""
         return self.config['password']
 
+    @property
+    def properties(self):
+        """Buildbot properties set on builds run by this slave"""
+        return dict(
+            parallel_jobs = self.parallel_jobs,
+            )
+
     @property
     def dir(self):
         return os.path.join(self.global_config.base_dir, "slave")
 
+    @property
+    def worker_names(self):
+        """Names of the buildbot slaves this slave config provides"""
+        return [self.name]
+
     def build_slave_object(self):
         from buildbot import buildslave
-        return buildslave.BuildSlave(self.name, self.password)
+        return buildslave.BuildSlave(self.name, self.password,
+                                     properties=self.properties)
+
+    def build_slave_objects(self):
+        """Buildbot slave objects, one per name in `worker_names`"""
+        return [self.build_slave_object()]
 
     def dump(self):
         from pprint import pprint
@@ -92,12 +127,50 @@ class SlaveConfig(AbstractSlaveConfig):
 class DigitalOceanSlaveConfig(AbstractSlaveConfig):
     slave_class_name = 'DigitalOcean'
 
+    # Pool droplets boot under generic names; claiming one renames it
+    # and tags it with the claiming slave's name, readable from the
+    # droplet's metadata service
+    pool_name_prefix = 'dbb-pool'
+    slave_tag_prefix = 'dbb-slave:'
+    metadata_tags_url = 'http://169.254.169.254/metadata/v1/tags/'
+
+    @classmethod
+    def is_pool_droplet(cls, hostname):
+        return hostname.startswith(cls.pool_name_prefix + '-')
+
+    @classmethod
+    def slave_tag(cls, slave_name):
+        """Droplet tag naming a slave; tags allow only [a-zA-Z0-9_:-]"""
+        return cls.slave_tag_prefix + \
+            re.sub(r'[^a-zA-Z0-9_-]', '_', slave_name)
+
+    @classmethod
+    def get_slave_name_by_droplet_tag(cls, timeout=2):
+        """Name of the slave that claimed this droplet, or None"""
+        import urllib2
+        try:
+            tags = urllib2.urlopen(cls.metadata_tags_url,
+                                   timeout=timeout).read().split()
+        except (urllib2.URLError, socket.error):
+            return None
+        for name in sorted(cls.global_config.config.get('slaves', {})):
+            if cls.slave_tag(name) in tags:
+                return name
+        return None
+
     def __init__(self, slave_name):
         super(DigitalOceanSlaveConfig, self).__init__(slave_name)
         self.image = self.config['image']
         self.size_slug = self.config['size_slug']
         self.region = self.config['region']
         self.token = self.global_config.config['digitalocean']['token']
+        self.build_wait_timeout = self.config.get('build_wait_timeout',
+                                                  60 * 10)
+        # Optional warm pool of idle droplets
+        pool = self.config.get('pool', None) or {}
+        self.pool_size = pool.get('size', 0)
+        self.pool_idle_ttl = pool.get('idle_ttl', 60 * 60)
+        self.pool_max_hourly_cost = pool.get('max_hourly_cost', None)
 
     def build_slave_object(self):
         from digitalocean_buildslave import DigitalOceanLatentBuildSlave
@@ -109,26 +182,128 @@ class DigitalOceanSlaveConfig(AbstractSlaveConfig):
             region=self.region,
             image=self.image,
             size_slug=self.size_slug,
+            properties=self.properties,
+            build_wait_timeout=self.build_wait_timeout,
+            pool_size=self.pool_size,
+            pool_idle_ttl=self.pool_idle_ttl,
+            pool_max_hourly_cost=self.pool_max_hourly_cost,
         )
 
+class DockerSlaveConfig(AbstractSlaveConfig):
+    slave_class_name = 'docker'
+
+    def __init__(self, slave_name):
+        super(DockerSlaveConfig, self).__init__(slave_name)
+        self.max_workers = self.config.get('max_workers', 2)
+        self.keep_warm = self.config.get('keep_warm', False)
+        self.build_wait_timeout = self.config.get('build_wait_timeout', 60)
+
+    @property
+    def worker_names(self):
+        return [ '%s-%d' % (self.name, i)
+                 for i in range(1, self.max_workers + 1) ]
+
+    def build_slave_objects(self):
+        from docker_buildslave import DockerLatentBuildSlave
+        return [ DockerLatentBuildSlave(
+                name=name,
+                password=self.password,
+                config=self.global_config.for_host(self.name),
+                keep_warm=self.keep_warm,
+                properties=self.properties,
+                build_wait_timeout=self.build_wait_timeout,
+                ) for name in self.worker_names ]
+
 
 class config(object):
+    # Parsed config files in this process, by path
+    _loaded = {}
+
     def __init__(self, config_file, hostname=None):
         self.config_file = config_file
-        self.config = yaml.load(file(config_file,"r"))
+        self.config = self.load(config_file)
         AbstractSlaveConfig.global_config = self
+        self.slave_configs = {}
+        self.build_indexes()
 
         # Go through some antics to automatically figure out hostname
-        host_hostname = socket.gethostname()
         if hostname is None:  # Look in slaves list
-            host_slaves = [
-                s for s in self.config['slaves'] \
-                if self.config['slaves'][s]['host'] == socket.gethostname() ]
+            host_slaves = AbstractSlaveConfig.host_slave_names()
             if len(host_slaves) == 1:
                 hostname = host_slaves[0]
         self.hostname = hostname
 
-        self.slave = AbstractSlaveConfig.get_slave_config(hostname)
+    @classmethod
+    def load(cls, config_file):
+        """
+        Parse the YAML config file with the C loader when available;
+        parsed configs are cached in memory and in a pickle next to
+        the file, keyed by the file's mtime, size and hash
+        """
+        with open(config_file, 'rb') as f:
+            data = f.read()
+        st = os.stat(config_file)
+        key = (st.st_mtime, st.st_size, hashlib.sha1(data).hexdigest())
+        if cls._loaded.get(config_file, (None,))[0] == key:
+            return cls._loaded[config_file][1]
+
+        cache_file = os.path.join(
+            os.path.dirname(config_file),
+            '.%s.pickle' % os.path.basename(config_file))
+        try:
+            with open(cache_file, 'rb') as f:
+                cached_key, parsed = pickle.load(f)
+        except Exception:
+            # Missing, or corrupt in any of many ways; parse and rewrite
+            cached_key = None
+        if cached_key != key:
+            # yaml is slow to import; only needed on a cache miss
+            import yaml
+            parsed = yaml.load(data, Loader=getattr(yaml, 'CLoader',
+                                                    yaml.Loader))
+            try:
+                with open(cache_file + '.tmp', 'wb') as f:
+                    pickle.dump((key, parsed), f, pickle.HIGHEST_PROTOCOL)
+                os.rename(cache_file + '.tmp', cache_file)
+            except (IOError, OSError):
+                pass  # Read-only tree; just don't cache
+        cls._loaded[config_file] = (key, parsed)
+        return parsed
+
+    def build_indexes(self):
+        """Index slaves by host and by builder"""
+        self.host_index = {}
+        self.builder_index = {}
+        for name in sorted(self.config.get('slaves', None) or {}):
+            params = self.config['slaves'][name]
+            self.host_index.setdefault(
+                params.get('host', name), []).append(name)
+            builders = params.get('builders', None)
+            if builders is None:
+                continue
+            if not isinstance(builders, list):
+                builders = [builders]
+            for builder in builders:
+                self.builder_index.setdefault(builder, []).append(name)
+
+    def for_host(self, hostname):
+        """
+        Return a copy of this configuration for another host, sharing
+        the parsed configuration file
+        """
+        res = copy.copy(self)
+        res.hostname = hostname
+        for attr in ('_slave', '_subs'):
+            if hasattr(res, attr):
+                delattr(res, attr)
+        return res
+
+    @property
+    def slave(self):
+        """Slave configuration for this host, looked up on demand"""
+        if not hasattr(self, '_slave'):
+            self._slave = AbstractSlaveConfig.get_slave_config(self.hostname)
+        return self._slave
 
     def dump(self):
         from pprint import pprint
@@ -143,12 +318,53 @@ class config(object):
     @property
     def base_dir(self):
         """Base directory of this tree"""
-        return os.path.dirname(os.path.realpath(self.config_file))
+        if not hasattr(self, '_base_dir'):
+            self._base_dir = os.path.dirname(
+                os.path.realpath(self.config_file))
+        return self._base_dir
+
+    @property
+    def host_dir(self):
+        """
+        Path of this tree on the Docker host, for bind mounts; in a
+        container, from the `host_dir` config or the `DBB_HOST_DIR`
+        environment set when the container was created
+        """
+        return self.config.get('host_dir', None) or \
+            os.environ.get('DBB_HOST_DIR', None) or self.base_dir
+
+    @property
+    def docker_slaves(self):
+        """Names of slaves configured with `slave_type: docker`"""
+        return sorted([ name for name, params in
+                        self.config.get('slaves', {}).items()
+                        if params.get('slave_type', None) == 'docker' ])
 
     @property
     def dbb_executable(self):
         return "bin/dbb"  # lame, I know; needs to work both inside and out
 
+    @property
+    def build_index(self):
+        """Local index of image build context hashes"""
+        return os.path.join(self.base_dir, ".dbb-build-index.json")
+
+    @property
+    def docker_api_version_file(self):
+        """Local cache of Docker daemon API versions"""
+        return os.path.join(self.base_dir, ".docker-api-version.json")
+
+    @property
+    def dbb_base_image(self):
+        """Tag of the shared base image for this host's base image"""
+        return 'dbb-base:%s' % \
+            re.sub(r'[^a-zA-Z0-9_.-]+', '-', self.slave.base_image)
+
+    @property
+    def dbb_base_images(self):
+        """Tags of the shared base images for all configured hosts"""
+        return set([ self.for_host(s).dbb_base_image for s in self.slaves ])
+
     @property
     def lib_dir(self):
         """Lib directory within this tree"""
@@ -167,6 +383,75 @@ class config(object):
     def http_proxy(self):
         return self.config.get('http_proxy', '')
 
+    @property
+    def apt_cache(self):
+        """Package cache container settings"""
+        res = dict(
+            name = 'dbb-apt-cache',
+            image = 'sameersbn/apt-cacher-ng',
+            port = 3142,
+            volume = 'dbb-apt-cache',
+            url = None,
+            )
+        res.update(self.config.get('apt_cache', None) or {})
+        return res
+
+    @property
+    def context_files(self):
+        """Extra files and directories under lib/ for the build context"""
+        return self.config.get('context_files', None) or []
+
+    @property
+    def context_exclude(self):
+        """Patterns excluded from the build context"""
+        return self.config.get('context_exclude', None) or []
+
+    @property
+    def context_compress(self):
+        """Gzip the build context sent to the Docker daemon"""
+        return self.config.get('context_compress', False)
+
+    @property
+    def packages(self):
+        """Per-stage apt package groups for the Dockerfile"""
+        return self.config.get('packages', None) or {}
+
+    @property
+    def dockerfile_layers(self):
+        """Dockerfile package layers:  `many` or `minimal`"""
+        layers = self.config.get('dockerfile_layers', 'many')
+        if layers not in ('many', 'minimal'):
+            raise RuntimeError("dockerfile_layers must be 'many' or "
+                               "'minimal', not '%s'" % layers)
+        return layers
+
+    @property
+    def ccache(self):
+        """Compiler cache settings"""
+        res = dict(
+            enabled = True,
+            dir = '/home/docker/.ccache',
+            max_size = '5G',
+            )
+        res.update(self.config.get('ccache', None) or {})
+        return res
+
+    @property
+    def git_mirror(self):
+        """Shared git mirror settings"""
+        res = dict(
+            enabled = True,
+            refresh_interval = 300,
+            )
+        res.update(self.config.get('git_mirror', None) or {})
+        return res
+
+    @property
+    def ccache_volume(self):
+        """Docker volume name for this host's base image compiler cache"""
+        return 'dbb-ccache-%s' % \
+            re.sub(r'[^a-zA-Z0-9_.-]+', '-', self.slave.base_image)
+
     @property
     def uid(self):
         return self.config.get('uid', os.getuid())
@@ -195,9 +480,11 @@ class config(object):
     def subs(self):
         """
         Return list of substitutions used in templates for Docker
-        image build
+        image build; computed once per host
         """
-        return dict(
+        if hasattr(self, '_subs'):
+            return self._subs
+        self._subs = dict(
             hostname = self.hostname,
             base_dir = self.base_dir,
             container_dir = self.container_dir,
@@ -207,24 +494,25 @@ class config(object):
             uid = self.uid,
             gid = self.gid,
             base_image = self.slave.base_image,
+            dbb_base_image = self.dbb_base_image,
             tcl_ver = self.slave.tcl_ver,
             maintainer_name = self.maintainer_name,
             maintainer_email = self.maintainer_email,
             supervisord_conf = self.supervisord_conf,
+            ccache_dir = self.ccache['dir'],
             master_name = self.master_name,
             master_host = self.master_host,
             master_dir = self.master_dir,
             slave_dir = self.slave.dir,
             )
+        return self._subs
 
     def render_template(self, fname, extra_subs = {}):
-        res = ''
-        subs = self.subs.copy()
-        subs.update(extra_subs)
-        with open(fname, 'r') as f:
-            for line in f:
-                res += line % subs
-        return res
+        subs = self.subs
+        if extra_subs:
+            subs = subs.copy()
+            subs.update(extra_subs)
+        return compiled_template.load(fname).render(subs)
 
 
     ##########################
@@ -242,6 +530,12 @@ class config(object):
     def buildbotURL(self):
         return self.config.get('buildbotURL', 'http://localhost:8010')
 
+    @property
+    def metrics_url(self):
+        """URL of the master's metrics, read by `dbb --stats`"""
+        return self.config.get('metrics_url',
+                               self.buildbotURL.rstrip('/') + '/metrics')
+
     @property
     def git_repo(self):
         return self.config['git_repo']
@@ -250,6 +544,30 @@ class config(object):
     def git_branch(self):
         return self.config.get('git_branch', 'master')
 
+    @property
+    def build_mode(self):
+        """Builder checkout and build mode:  `full` or `incremental`"""
+        mode = self.config.get('build_mode', 'full')
+        if mode not in ('full', 'incremental'):
+            raise RuntimeError("build_mode must be 'full' or "
+                               "'incremental', not '%s'" % mode)
+        return mode
+
+    @property
+    def full_build_every(self):
+        """In incremental mode, do a clean build every N builds"""
+        return self.config.get('full_build_every', 20)
+
+    @property
+    def test_shards(self):
+        """Number of parallel regression test shards"""
+        return self.config.get('test_shards', 1)
+
+    @property
+    def test_durations_file(self):
+        """Per-test durations history, kept on the master"""
+        return os.path.join(self.master_dir, "test-durations.json")
+
     @property
     def admin_users(self):
         return self.config.get('admin_users', {})
@@ -276,3 +594,24 @@ class config(object):
     def get_slave_config(self, slave_name):
         return AbstractSlaveConfig.get_slave_config(slave_name)
 
+    def build_matrix(self):
+        """
+        Return list of builders, one per (base_image, flavor)
+        combination among the slaves, each with the names of slaves
+        having that base image and flavor
+        """
+        matrix = {}
+        for name in sorted(self.slaves):
+            sc = self.get_slave_config(name)
+            for flavor in sc.flavors:
+                matrix.setdefault((sc.base_image, flavor), []).extend(
+                    sc.worker_names)
+        return [ dict(
+                name = '%s-%s' % (re.sub(r'[^a-zA-Z0-9]+', '-', base_image),
+                                  flavor),
+                base_image = base_image,
+                flavor = flavor,
+                slavenames = slavenames,
+                ) for ((base_image, flavor), slavenames)
+                 in sorted(matrix.items()) ]
+
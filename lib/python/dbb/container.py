@@ -1,114 +1,266 @@
 # See http://docker-py.readthedocs.org/en/latest/api/
 
 import docker
-import dockerpty
 from dbb.docker_context import docker_context
+from dbb.build_log import build_log
+from dbb.apt_cache import apt_cache
 from dbb.init import init
-import sys, os, re, socket
+from dbb.readiness import readiness
+from dbb.client import client
+from dbb.git_mirror import git_mirror
+import sys, os, socket, json, threading
 
 class container(object):
-    def __init__(self, config):
+    # Serialize build index updates from parallel builds
+    index_lock = threading.Lock()
+
+    def __init__(self, config, client=None):
         self.config = config
+        if client is not None:
+            self._c = client
         self.context = docker_context(config)
+        self.base_context = docker_context(config, base=True)
         self._init = init(config)
 
     @property
     def c(self):
         """Docker client object, generated only on demand"""
         if not hasattr(self, '_c'):
-            self._c = docker.Client(base_url='unix://var/run/docker.sock',
-                                    version='auto')
+            self._c = client(self.config)
         return self._c
 
-    re_subs = (
-        # Undo docker-py markup, {"stream":"[...]"}
-        (r'^{\"stream\":\"(.*)\"}\s*$', lambda m: m.group(1)),
-        # Escaped characters
-        (r'\\u0026', '&'),
-        (r'\\(u0009|t)', ' '), # tab -> spc
-        (r'\\u003c', '<'),
-        (r'\\u003e', '>'),
-        (r'\\u001b\[[0-9]+m', ''), # Terminal colors
-        # Whitespace
-        (r'\\r', '\r'), # LF
-        (r'\\n', '\n'), # CR
-        (r' +', ' '), # collapse spaces
-        )
+    @property
+    def apt_cache(self):
+        """Package cache container manager"""
+        if not hasattr(self, '_apt_cache'):
+            self._apt_cache = apt_cache(self.config, self.c)
+        return self._apt_cache
+
+    def _lookup(self, key, inspect, name=None):
+        """
+        Inspect an object by name, default the host name, returning
+        None if it doesn't exist; results are memoized until
+        `invalidate()`
+        """
+        if not hasattr(self, '_lookups'):
+            self._lookups = {}
+        if key not in self._lookups:
+            try:
+                self._lookups[key] = inspect(name or self.config.hostname)
+            except docker.errors.APIError as e:
+                if e.response is None or e.response.status_code != 404:
+                    raise
+                self._lookups[key] = None
+        return self._lookups[key]
+
+    def invalidate(self):
+        """Forget memoized lookups after changing container or image state"""
+        self._lookups = {}
 
     def image(self):
-        ilist = [ i for i in self.c.images()
-                  if u'%s:latest' % self.config.hostname in i['RepoTags'] ]
-        return (ilist + [None])[0]
+        """Image inspect data, or None if not built"""
+        return self._lookup('image', self.c.inspect_image)
+
+    hash_label = 'dbb.context-hash'
+    base_label = 'dbb.base'
+    docker_socket = '/var/run/docker.sock'
+
+    # Serialize builds of each base image shared by parallel host builds
+    build_locks = {}
+
+    def read_index(self):
+        """Read the local build index, mapping image tags to context
+        hashes and image IDs"""
+        if not os.path.exists(self.config.build_index):
+            return {}
+        with open(self.config.build_index, 'r') as f:
+            return json.load(f)
 
-    def build(self):
+    def update_index(self, tag, context_hash, image_id):
+        with self.index_lock:
+            index = self.read_index()
+            index[tag] = dict(hash = context_hash, image = image_id)
+            with open(self.config.build_index, 'w') as f:
+                json.dump(index, f, indent=2, sort_keys=True)
+
+    def image_is_current(self, image, tag, context_hash):
+        """Return True if the existing image was built from a context
+        with the same hash"""
+        if image is None:
+            return False
+        # Check the local index first; fall back to the image label
+        entry = self.read_index().get(tag, {})
+        if entry.get('image') == image['Id']:
+            return entry.get('hash') == context_hash
+        labels = image['Config'].get('Labels')
+        return (labels or {}).get(self.hash_label) == context_hash
+
+    def build_image(self, context, tag, image, salt='', labels={},
+                    force=False, log_format='plain'):
+        """Build an image from a context unless it's up to date;
+        return the image"""
+        context_hash = context.hash(salt)
+        if not force and self.image_is_current(image, tag, context_hash):
+            sys.stderr.write("Image %s is up to date (context %s); "
+                             "use --force to rebuild\n" % \
+                                 (tag, context_hash[:12]))
+            return image
+
+        # Route package downloads through the cache; as a build arg,
+        # this doesn't affect the image or layer cache
+        buildargs = None
+        if not self.config.http_proxy and self.apt_cache.is_running():
+            buildargs = dict(http_proxy = self.apt_cache.proxy_url)
+            sys.stderr.write("Using package cache at %s\n" % \
+                                 buildargs['http_proxy'])
+
+        labels = dict(labels)
+        labels[self.hash_label] = context_hash
         output = self.c.build(
-            fileobj = self.context.file(),
+            fileobj = context.file(labels),
             custom_context = True, # indicate fileobj is a tarball
-            tag = self.config.hostname,
+            encoding = context.encoding,
+            tag = tag,
             rm = True,
+            buildargs = buildargs,
             )
+        self.invalidate()
 
-        for line in output:
-            # Make output readable
-            for regex, repl in self.re_subs:
-                line = re.sub(regex, repl, line)
-            sys.stdout.write(line)
+        log = build_log(log_format)
+        for event in log.events(output):
+            log.write(event)
+            if event['type'] == 'error':
+                sys.stderr.write("Error:  build failed:  %s\n" % \
+                                     event['message'])
+                sys.exit(1)
+        image = self.c.inspect_image(tag)
+        self.update_index(tag, context_hash, image['Id'])
         sys.stderr.write("Built image, tags %s\n" % \
-                             ', '.join(self.image()['RepoTags']))
+                             ', '.join(image['RepoTags']))
+        return image
+
+    def build(self, force=False, log_format='plain'):
+        """Build the shared base image if needed, then the host's image"""
+        tag = self.config.dbb_base_image
+        with self.index_lock:
+            lock = self.build_locks.setdefault(tag, threading.Lock())
+        with lock:
+            base = self.build_image(
+                self.base_context, tag, self.base_image(),
+                labels = {self.base_label : self.config.slave.base_image},
+                force = force, log_format = log_format)
+        self.build_image(
+            self.context, self.config.hostname, self.image(),
+            salt = base['Id'], force = force, log_format = log_format)
+
+    def base_image(self):
+        """Shared base image inspect data, or None if not built"""
+        return self._lookup('base_image', self.c.inspect_image,
+                            self.config.dbb_base_image)
+
+    def gc_base(self):
+        """
+        Remove shared base images no longer used by any configured
+        host, and old untagged base images
+        """
+        wanted = self.config.dbb_base_images
+        stale = [ i for i in self.c.images(
+                filters = dict(label = self.base_label))
+                  if not wanted.intersection(i.get('RepoTags') or []) ]
+        for image in stale:
+            name = ', '.join([ t for t in image.get('RepoTags') or []
+                               if t != '<none>:<none>' ]) or image['Id'][:19]
+            try:
+                self.c.remove_image(image['Id'])
+                sys.stderr.write("Removed base image %s\n" % name)
+            except docker.errors.APIError as e:
+                sys.stderr.write("Warning:  not removing base image %s:  %s\n"
+                                 % (name, e.explanation or e))
+        self.invalidate()
 
     def container(self):
-        clist = [ c for c in self.c.containers(all=True)
-                  if u'/%s' % self.config.hostname in c['Names'] ]
-        return (clist + [None])[0]
+        """Container inspect data, or None if not created"""
+        return self._lookup('container', self.c.inspect_container)
+
+    def create_container(self, cmd=None, name=None, publish=True):
+        """
+        Create a container from this host's image, by default the
+        host's own container running supervisord; with `publish` unset,
+        no ports are published to the host
 
-    def create_container(self, cmd=None):
+        The host's own container gets the Docker socket when any docker
+        latent slaves are configured, so its master can start workers
+        """
+        host_container = name is None
+        if name is None:
+            name = self.config.hostname
         if cmd is None:
             cmd = ["/usr/bin/sudo", "-n", \
                    "/usr/bin/supervisord", "-n", \
                    "-c", "/etc/supervisor/supervisord.conf"]
+        binds = {
+            self.config.host_dir : dict(
+                bind = self.config.container_dir,
+                mode = 'rw',
+                ),
+            '/tmp/.X11-unix' : dict( # X display
+                bind = '/tmp/.X11-unix',
+                mode = 'rw',
+                ),
+            }
+        if self.config.ccache['enabled']:
+            # Compiler cache volume, shared by containers with the
+            # same base image
+            binds[self.config.ccache_volume] = dict(
+                bind = self.config.ccache['dir'],
+                mode = 'rw',
+                )
+        group_add = None
+        if host_container and self.config.docker_slaves:
+            binds[self.docker_socket] = dict(
+                bind = self.docker_socket,
+                mode = 'rw',
+                )
+            if os.path.exists(self.docker_socket):
+                # Let the container user use the socket
+                group_add = [os.stat(self.docker_socket).st_gid]
         c = self.c.create_container(
             image = self.config.hostname,
             detach = False,
             stdin_open = True,
             command = cmd,
-            hostname = self.config.hostname,
-            name = self.config.hostname,
+            hostname = name,
+            name = name,
             user = self.config.uid,
             tty = True,
-            ports = [8010, 9989, 22],
+            ports = [8010, 9989, 22] if publish else None,
             environment = dict(
                 DISPLAY = os.environ.get('DISPLAY',''),
                 HOSTNAME = socket.gethostname(),
+                DBB_HOST_DIR = self.config.host_dir,
                 ),
-            volumes = [self.config .container_dir, '/tmp/.X11-unix'],
+            volumes = [ b['bind'] for b in binds.values() ],
             host_config = self.c.create_host_config(
-                binds = {
-                    self.config.base_dir : dict(
-                        bind = self.config.container_dir,
-                        mode = 'rw',
-                        ),
-                    '/tmp/.X11-unix' : dict( # X display
-                        bind = '/tmp/.X11-unix',
-                        mode = 'rw',
-                        ),
-                    },
+                binds = binds,
                 port_bindings = {
                     8010 : 80,
                     9989 : 9989,
                     22 : 2222,
-                    },
+                    } if publish else None,
                 privileged = True,
+                group_add = group_add,
                 )
             )
+        self.invalidate()
         print "Created container %s" % c['Id'][:12]
+        return c
 
     def is_running(self):
         if not self.container():
             return False
-        i = self.c.inspect_container(self.config.hostname)
-        return i['State']['Running']
+        return self.container()['State']['Running']
 
-    def run(self, cmd=None):
+    def run(self, cmd=None, wait=False, wait_timeout=60):
         if self.container() and self.is_running():
             sys.stderr.write("Error:  container already running\n")
             sys.exit(1)
@@ -121,20 +273,30 @@ class container(object):
 
         # Start the container if needed
         self.c.start(self.config.hostname)
+        self.invalidate()
         sys.stderr.write("Container started\n")
+        if wait:
+            readiness(self).wait(wait_timeout)
 
     def logs(self):
         if not self.container() or not self.is_running():
             return
         for l in self.c.logs(self.config.hostname, stream=True):
             sys.stdout.write(l)
+        # Log stream ends when the container exits
+        self.invalidate()
 
     def init(self):
         if os.environ.get('CONTAINER', None) == 'docker-bb':
             # Assume we're in the container; initialize it
             self._init.init()
+        elif self.is_running():
+            # Assume we're in the host OS; exec command in the
+            # running container
+            self.exec_init()
         else:
-            # Assume we're in the host OS; re-run command in container
+            # Assume we're in the host OS; re-run command in a
+            # one-shot container
             if self.container():
                 sys.stderr.write(
                     "Error:  container exists; please remove before init\n")
@@ -150,20 +312,32 @@ class container(object):
             finally:
                 self.remove()
 
+    def exec_init(self):
+        """Run init in the running container with a one-shot exec"""
+        cmd = [self.config.dbb_executable,
+               "-H", self.config.hostname, "--init"]
+        sys.stderr.write("Running init in Docker container\n")
+        ex = self.c.exec_create(self.config.hostname, cmd)
+        for l in self.c.exec_start(ex['Id'], stream=True):
+            sys.stdout.write(l)
+        if self.c.exec_inspect(ex['Id'])['ExitCode'] != 0:
+            sys.stderr.write("Error:  init failed in container\n")
+            sys.exit(1)
+
     def attach(self):
         if not self.container():
             sys.stderr.write("Error:  container does not exist\n")
             sys.exit(1)
 
-        dockerpty.start(
-            self.c,
-            self.c.inspect_container(self.config.hostname))
+        import dockerpty
+        dockerpty.start(self.c, self.container())
 
     def stop(self):
         if not self.is_running():
             sys.stderr.write("Error:  container is not running\n")
             sys.exit(1)
         self.c.stop(self.config.hostname)
+        self.invalidate()
         sys.stderr.write("Container stopped\n")
 
     def remove(self):
@@ -176,6 +350,7 @@ class container(object):
             sys.exit(1)
 
         self.c.remove_container(self.config.hostname)
+        self.invalidate()
         sys.stderr.write("Container removed\n")
 
     def dump(self):
@@ -188,13 +363,23 @@ class container(object):
         # Print container info
         print "Container:"
         if self.container():
-            pprint(self.c.inspect_container(self.config.hostname))
+            pprint(self.container())
         else:
             print "    (none)"
         
         # Print image info
         print "Image:"
         if self.image():
-            pprint(self.c.inspect_image(self.config.hostname))
+            pprint(self.image())
         else:
             print "    (none)"
+
+        # Print base image info
+        print "Base image:"
+        if self.base_image():
+            pprint(self.base_image())
+        else:
+            print "    (none)"
+
+        # Print git mirror status
+        git_mirror(self.config).dump()
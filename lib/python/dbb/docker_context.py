@@ -1,35 +1,191 @@
-import tarfile, sys
+import tarfile, sys, os, hashlib, fnmatch, gzip, shutil, tempfile
 from StringIO import StringIO
-from io import BytesIO
-from dbb.dockerfile import dockerfile
+from dbb.dockerfile import dockerfile, base_dockerfile
 from dbb.deb_control import deb_control
 
 class docker_context(object):
-    def __init__(self, config):
+    # Context tarball is kept in memory up to this size, then spooled
+    # to disk
+    spool_size = 16 * 1024 * 1024
+
+    def __init__(self, config, base=False):
+        """
+        Context for the host's image, or with `base` set, for the
+        shared base image it's built from
+        """
         self.config = config
-        self.dockerfile = dockerfile(config)
-        self.deb_control = deb_control(config)
+        self.base = base
+        if base:
+            self.dockerfile = base_dockerfile(config)
+            self.deb_control = None
+        else:
+            self.dockerfile = dockerfile(config)
+            self.deb_control = deb_control(config)
+
+    @property
+    def templates(self):
+        return [ t for t in (self.dockerfile, self.deb_control)
+                 if t is not None ]
+
+    @property
+    def exclude_patterns(self):
+        """
+        Exclusion patterns from `lib/.dockerignore` and the
+        `context_exclude` config; a leading `!` re-includes
+        """
+        if not hasattr(self, '_exclude_patterns'):
+            patterns = []
+            ignore_file = os.path.join(self.config.lib_dir, '.dockerignore')
+            if os.path.exists(ignore_file):
+                with open(ignore_file, 'r') as f:
+                    patterns = [ l.strip() for l in f
+                                 if l.strip() and not l.startswith('#') ]
+            self._exclude_patterns = \
+                patterns + list(self.config.context_exclude)
+        return self._exclude_patterns
 
-    def _addfile(self, tarball, template):
-        s = template.__str__()
-        ti = tarfile.TarInfo(name=template.filename)
-        ti.size = len(s)
+    def is_excluded(self, name):
+        """Last matching pattern for the name or a parent directory wins"""
+        parts = name.split('/')
+        paths = [ '/'.join(parts[:i]) for i in range(1, len(parts) + 1) ]
+        excluded = False
+        for pattern in self.exclude_patterns:
+            negate = pattern.startswith('!')
+            pattern = pattern.lstrip('!').strip('/')
+            if [ p for p in paths if fnmatch.fnmatch(p, pattern) ]:
+                excluded = not negate
+        return excluded
+
+    def extra_files(self):
+        """
+        Sorted list of (context name, path) for the files and
+        directory trees under `lib/` listed in `context_files`
+        """
+        if self.base:
+            return []
+        if hasattr(self, '_extra_files'):
+            return self._extra_files
+        res = set()
+        for entry in self.config.context_files:
+            path = os.path.join(self.config.lib_dir, entry)
+            if not os.path.exists(path):
+                raise RuntimeError("Context file '%s' not found" % path)
+            if not os.path.isdir(path):
+                res.add((os.path.normpath(entry), path))
+                continue
+            for dirpath, dirnames, filenames in os.walk(path):
+                for fname in filenames:
+                    fpath = os.path.join(dirpath, fname)
+                    res.add((os.path.relpath(fpath, self.config.lib_dir),
+                             fpath))
+        self._extra_files = sorted(
+            [ (n, p) for (n, p) in res if not self.is_excluded(n) ])
+        return self._extra_files
+
+    def _tarinfo(self, name, size, mode=0644):
+        # Fixed ownership, mode and mtime keep the tarball reproducible
+        ti = tarfile.TarInfo(name=name)
+        ti.size = size
+        ti.mode = mode
+        ti.mtime = 0
         ti.uid = self.config.uid
         ti.gid = self.config.gid
-        tarball.addfile(ti, StringIO(s))
+        return ti
+
+    def _addfile(self, tarball, template, extra=''):
+        s = template.__str__() + extra
+        tarball.addfile(self._tarinfo(template.filename, len(s)), StringIO(s))
+
+    def _addpath(self, tarball, name, path):
+        mode = 0755 if os.access(path, os.X_OK) else 0644
+        with open(path, 'rb') as f:
+            tarball.addfile(
+                self._tarinfo(name, os.path.getsize(path), mode), f)
+
+    def hash(self, salt=''):
+        """
+        Content hash of the build context:  template substitutions
+        the templates use, template sources, rendered templates and
+        extra files, plus `salt`, e.g. the ID of the image it's built
+        from
+
+        Unused substitutions are left out, so hosts sharing a base
+        image agree on its hash
+        """
+        h = hashlib.sha256(salt)
+        for template in self.templates:
+            subs = template.all_subs
+            for key in sorted(template.compiled.keys):
+                h.update('%s=%s\n' % (key, subs.get(key)))
+        for template in self.templates:
+            with open(template.template, 'r') as f:
+                h.update(f.read())
+            h.update(template.__str__())
+        for name, path in self.extra_files():
+            h.update('%s %o\n' % (name, os.stat(path).st_mode & 0111))
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(65536), ''):
+                    h.update(block)
+        return h.hexdigest()
+
+    def check(self):
+        """
+        Report substitution keys unknown to or unused by all templates;
+        return False if any template has unknown keys
+        """
+        ok = True
+        unused = None
+        templates = self.templates
+        if not self.base:
+            # Keys may be used only in the base image's Dockerfile
+            templates.append(base_dockerfile(self.config))
+        for template in templates:
+            t_unknown, t_unused = template.check()
+            if t_unknown:
+                sys.stderr.write("Error:  %s:  unknown keys:  %s\n" % \
+                                     (template.template_name,
+                                      ', '.join(t_unknown)))
+                ok = False
+            unused = set(t_unused) if unused is None \
+                else unused.intersection(t_unused)
+        if unused:
+            sys.stderr.write("Warning:  keys unused by all templates:  %s\n" % \
+                                 ', '.join(sorted(unused)))
+        return ok
+
+    @property
+    def encoding(self):
+        """Context encoding to pass to the Docker daemon"""
+        return 'gzip' if self.config.context_compress else None
 
-    def file(self):
-        f = BytesIO()
-        t = tarfile.TarFile(fileobj=f, mode='w')
+    def file(self, labels={}):
+        """
+        Return the context tarball, gzipped if configured, in a
+        spooled temporary file positioned at the start
+        """
+        f = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        if self.config.context_compress:
+            z = gzip.GzipFile(filename='', mode='wb', fileobj=f, mtime=0)
+        else:
+            z = None
+        t = tarfile.TarFile(fileobj=z or f, mode='w')
 
-        self._addfile(t, self.dockerfile)
-        self._addfile(t, self.deb_control)
+        # Labels are appended to the Dockerfile, so they don't affect
+        # the context hash
+        label_lines = ''.join(
+            [ 'LABEL\t\t%s="%s"\n' % (k, labels[k]) for k in sorted(labels) ])
+        self._addfile(t, self.dockerfile, label_lines)
+        if self.deb_control is not None:
+            self._addfile(t, self.deb_control)
+        for name, path in self.extra_files():
+            self._addpath(t, name, path)
 
         t.close()
+        if z is not None:
+            z.close()
         f.seek(0)
         return f
 
     def dump(self):
         with self.file() as f:
-            for line in f:
-                sys.stdout.write(line)
+            shutil.copyfileobj(f, sys.stdout)
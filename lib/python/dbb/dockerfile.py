@@ -3,3 +3,70 @@ from .template import template
 class dockerfile(template):
     template_name = 'Dockerfile.template'
     filename = 'Dockerfile'
+
+    # Package install stages, in Dockerfile order; each is a list of
+    # package groups
+    stages = ('base', 'buildbot', 'app')
+    default_packages = dict(
+        base = [
+            ['build-essential', 'ccache', 'git'],
+            ],
+        buildbot = [
+            ['python-dev', 'python-pip'],
+            ['libffi-dev', 'libssl-dev'],  # DigitalOcean/ScaleWay APIs
+            ['supervisor'],
+            ['python-yaml'],               # Docker tools
+            ['sudo'],
+            ['ssh'],
+            ],
+        app = [
+            ['devscripts', 'equivs'],      # MK build deps tools
+            ['bwidget', 'avahi-daemon',    # MK run-time deps
+             'python-imaging', 'python-imaging-tk', 'python-gnome2',
+             'python-glade2', 'python-numpy', 'python-gtksourceview2',
+             'python-vte', 'python-xlib', 'python-gtkglext1',
+             'python-configobj', 'python-gst0.10', 'python-avahi',
+             'tclreadline', 'bc', 'libgl1-mesa-dri', 'netcat-openbsd',
+             'tcl%(tcl_ver)s', 'tk%(tcl_ver)s'],
+            ['xterm'],                     # for touchy
+            ['iproute2'],                  # test shard isolation
+            ['gnome-icon-theme',           # for gmoccapy
+             'gstreamer0.10-plugins-base'],
+            ],
+        )
+
+    def packages(self, stage):
+        """Package groups for a stage, from config or defaults"""
+        groups = self.config.packages.get(stage, self.default_packages[stage])
+        return [ [ p % self.config.subs for p in group ] for group in groups ]
+
+    def apt_install(self, packages):
+        """Render a `RUN apt-get install` command, wrapping long lines"""
+        lines = ['']
+        for p in packages:
+            if lines[-1] and len(lines[-1]) + len(p) > 60:
+                lines.append('')
+            lines[-1] = ' '.join(lines[-1].split() + [p])
+        return 'RUN\t\tapt-get install -y \\\n' + \
+            ' \\\n'.join([ '\t\t    %s' % l for l in lines ])
+
+    def apt_stage(self, stage):
+        """
+        Render a stage's package installs:  one layer per group in
+        `many` layers mode, or one layer per stage in `minimal` mode
+        """
+        groups = [ g for g in self.packages(stage) if g ]
+        if not groups:
+            return '# (no packages)'
+        if self.config.dockerfile_layers == 'minimal':
+            return self.apt_install(sum(groups, []))
+        return '\n'.join([ self.apt_install(g) for g in groups ])
+
+    @property
+    def subs(self):
+        return dict([ ('apt_%s' % stage, self.apt_stage(stage))
+                      for stage in self.stages ])
+
+class base_dockerfile(dockerfile):
+    """Dockerfile for the base image shared by hosts' images"""
+    template_name = 'Dockerfile.base.template'
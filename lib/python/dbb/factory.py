@@ -0,0 +1,428 @@
+from buildbot.plugins import steps, util
+from buildbot.status.results import SUCCESS, WARNINGS
+from twisted.internet import threads
+from dbb.git_mirror import git_mirror
+import re, os, json, heapq, pipes, threading
+
+def ccache_stats(rc, stdout, stderr):
+    """Extract hit/miss build properties from `ccache -s` output"""
+    hits = misses = 0
+    for line in stdout.splitlines():
+        m = re.match(r'\s*(cache hit|cache miss)\b.*?(\d+)\s*$', line)
+        if m is None:
+            continue
+        if m.group(1) == 'cache hit':
+            hits += int(m.group(2))
+        else:
+            misses += int(m.group(2))
+    total = hits + misses
+    return dict(
+        ccache_hits = hits,
+        ccache_misses = misses,
+        ccache_hit_rate = round(100.0 * hits / total, 1) if total else 0.0,
+        )
+
+def fingerprint(rc, stdout, stderr):
+    """Extract stored and current configure fingerprints"""
+    res = dict(fingerprint_stored='', fingerprint='')
+    for line in stdout.splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[0] in ('stored', 'current'):
+            key = 'fingerprint' if fields[0] == 'current' \
+                else 'fingerprint_stored'
+            res[key] = fields[1]
+    return res
+
+def test_dirs(rc, stdout, stderr):
+    """Extract list of regression test directories"""
+    return dict(test_dirs = sorted(set(
+                [ l.strip() for l in stdout.splitlines() if l.strip() ])))
+
+class ShardedTests(steps.ShellCommand):
+    """
+    Run the regression tests in parallel shards on the slave, balanced
+    by historical per-test durations kept on the master
+
+    Tests start and stop a realtime instance, so each shard runs in its
+    own IPC, network and mount namespaces, with private `/dev/shm` and
+    `/tmp`, keeping shards' instances apart; this uses the privileged
+    container's passwordless sudo.
+
+    Each test's time is printed on a marker line, read back when the
+    step completes to update the durations file, in a thread, and to
+    add a `timings` log listing the slowest tests first.
+    """
+    marker = 'DBB-TEST-TIME'
+    # Serializes durations file updates by concurrent builds
+    durations_lock = threading.Lock()
+
+    def __init__(self, shards, durations_file, durations_key, **kwargs):
+        steps.ShellCommand.__init__(self, **kwargs)
+        self.shards = shards
+        self.durations_file = durations_file
+        self.durations_key = durations_key
+
+    def read_durations(self):
+        if not os.path.exists(self.durations_file):
+            return {}
+        with open(self.durations_file, 'r') as f:
+            return json.load(f)
+
+    def partition(self, tests, durations):
+        """
+        Assign tests to shards, longest first to the least loaded
+        shard; tests without history get the median duration
+        """
+        known = sorted(durations.values())
+        default = known[len(known) // 2] if known else 1.0
+        shards = [ (0.0, i, []) for i in range(self.shards) ]
+        for test in sorted(tests, key=lambda t: -durations.get(t, default)):
+            load, i, shard = heapq.heappop(shards)
+            shard.append(test)
+            heapq.heappush(
+                shards, (load + durations.get(test, default), i, shard))
+        return [ s[2] for s in sorted(shards, key=lambda s: s[1]) if s[2] ]
+
+    def script(self, shards):
+        lines = [
+            'rm -f ../test-shard-*.log ../test-failures',
+            # Shard script, run as `test-shard.sh DIR N TESTS...`
+            "cat > ../test-shard.sh <<'EOF'",
+            'cd "$1"; n=$2; shift 2',
+            '. ../scripts/rip-environment',
+            'for t in "$@"; do',
+            '    start=$(date +%s.%N)',
+            '    runtests -v "$t" >> ../test-shard-$n.log 2>&1',
+            '    rc=$?',
+            '    test $rc = 0 || echo "$t" >> ../test-failures',
+            '    echo "%s $t $rc $(awk "BEGIN { print $(date +%%s.%%N) - $start }")"'
+            % self.marker,
+            'done',
+            'EOF',
+            # Run a shard in new namespaces, back as this user
+            'shard() {',
+            '    sudo -n unshare --ipc --net --mount --fork -- sh -c \'',
+            '        mount --make-rprivate / &&',
+            '        ip link set lo up &&',
+            '        mount -t tmpfs tmpfs /dev/shm &&',
+            '        mount -t tmpfs tmpfs /tmp &&',
+            '        exec sudo -n -u "$0" bash "$@"\' \\',
+            '        "$(id -un)" "$(pwd)/../test-shard.sh" "$(pwd)" "$@"',
+            '}',
+            ]
+        for i, tests in enumerate(shards):
+            lines.append('shard %d %s &' % \
+                             (i, ' '.join([ pipes.quote(t) for t in tests ])))
+        lines += [
+            'wait',
+            'for log in ../test-shard-*.log; do',
+            '    echo "=== $log"; cat $log',
+            'done',
+            'test ! -s ../test-failures',
+            ]
+        return '\n'.join(lines)
+
+    def start(self):
+        durations = self.read_durations().get(self.durations_key, {})
+        shards = self.partition(self.getProperty('test_dirs') or [], durations)
+        self.command = ["bash", "-c", self.script(shards)]
+        steps.ShellCommand.start(self)
+
+    def commandComplete(self, cmd):
+        timings = []
+        for line in self.getLog('stdio').getText().splitlines():
+            fields = line.split()
+            if len(fields) == 4 and fields[0] == self.marker:
+                try:
+                    timings.append((float(fields[3]), fields[1], fields[2]))
+                except ValueError:
+                    continue
+        if not timings:
+            return
+        timings.sort(reverse=True)
+        self.addCompleteLog('timings', ''.join(
+                [ '%8.1fs  %s%s\n' % (secs, test,
+                                      '' if rc == '0' else '  (failed)')
+                  for (secs, test, rc) in timings ]))
+
+        # Update the history on the master, off the reactor thread
+        return threads.deferToThread(self.update_durations, timings)
+
+    def update_durations(self, timings):
+        with self.durations_lock:
+            all_durations = self.read_durations()
+            durations = all_durations.setdefault(self.durations_key, {})
+            for secs, test, rc in timings:
+                durations[test] = secs
+            with open(self.durations_file + '.tmp', 'w') as f:
+                json.dump(all_durations, f, indent=2, sort_keys=True)
+            os.rename(self.durations_file + '.tmp', self.durations_file)
+
+class build_factory(object):
+    """
+    Buildbot build factory for one build matrix entry, a
+    (base_image, flavor) combination
+    """
+    def __init__(self, config, builder):
+        self.config = config
+        self.builder = builder
+
+    @property
+    def flavor(self):
+        return self.builder['flavor']
+
+    @property
+    def env(self):
+        """Build environment, with compiler cache wiring"""
+        ccache = self.config.ccache
+        if not ccache['enabled']:
+            return dict(MK_ANNOUNCE_DISABLE='1')
+        return dict(
+            MK_ANNOUNCE_DISABLE='1',
+            CCACHE_DIR=ccache['dir'],
+            CCACHE_MAXSIZE=ccache['max_size'],
+            CC='ccache gcc',
+            CXX='ccache g++',
+            )
+
+    @property
+    def incremental(self):
+        return self.config.build_mode == 'incremental'
+
+    @property
+    def configure_args(self):
+        return ["--with-%s" % self.flavor]
+
+    def last_slave_build(self, build):
+        """The builder's last finished build on this build's slave, or
+        None"""
+        slavename = build.getSlavename()
+        for last in build.builder.builder_status.generateFinishedBuilds(
+            num_builds=1, filter_fn=lambda b: b.getSlavename() == slavename):
+            return last
+        return None
+
+    def clean_build(self, step):
+        """
+        Whether this build starts from a clean checkout:  always in
+        full build mode; in incremental mode, every
+        `full_build_every` builds or when the last build on this
+        slave, whose work tree this build reuses, failed
+        """
+        build = step.build
+        if build.getProperty('clean_build') is None:
+            every = self.config.full_build_every
+            clean = not self.incremental \
+                or (every and build.getProperty('buildnumber') % every == 0)
+            if not clean:
+                last = self.last_slave_build(build)
+                clean = last is None \
+                    or last.getResults() not in (SUCCESS, WARNINGS)
+            build.setProperty('clean_build', bool(clean), 'build_factory')
+        return build.getProperty('clean_build')
+
+    def need_configure(self, step):
+        """Whether to run autogen.sh and configure"""
+        if self.clean_build(step):
+            return True
+        props = step.build.getProperties()
+        return not props.getProperty('fingerprint_stored') or \
+            props.getProperty('fingerprint_stored') != \
+            props.getProperty('fingerprint')
+
+    @property
+    def mirror(self):
+        if not hasattr(self, '_mirror'):
+            self._mirror = git_mirror(self.config)
+        return self._mirror
+
+    @property
+    def reference(self):
+        """Reference repository for Git steps"""
+        return self.mirror.slave_path if self.mirror.enabled else None
+
+    def checkout(self):
+        res = []
+        if self.mirror.enabled:
+            res += [
+                # a stale or missing mirror only slows the checkout
+                steps.ShellCommand(
+                    name="git mirror",
+                    command=["sh", "-c", self.mirror.refresh_script()],
+                    flunkOnFailure=False,
+                    warnOnFailure=True,
+                    ),
+                ]
+        res += [
+            steps.Git(
+                name="git",
+                repourl=self.config.git_repo,
+                branch=self.config.git_branch,
+                mode='full',
+                reference=self.reference,
+                doStepIf=self.clean_build,
+                haltOnFailure=True,
+                ),
+            ]
+        if self.incremental:
+            res += [
+                # reuse the work tree
+                steps.Git(
+                    name="git incremental",
+                    repourl=self.config.git_repo,
+                    branch=self.config.git_branch,
+                    mode='incremental',
+                    reference=self.reference,
+                    doStepIf=lambda step: not self.clean_build(step),
+                    haltOnFailure=True,
+                    ),
+                # fingerprint configure inputs
+                steps.SetPropertyFromCommand(
+                    name="fingerprint",
+                    workdir="build/src",
+                    command=["sh", "-c",
+                             "echo stored $(cat .dbb-fingerprint "
+                             "2>/dev/null); echo current $( (echo %s; "
+                             "cat configure.ac) | sha1sum | cut -d' ' -f1)" %
+                             ' '.join(self.configure_args)],
+                    extract_fn=fingerprint,
+                    haltOnFailure=True,
+                    ),
+                ]
+        return res
+
+    def configure(self):
+        res = [
+            # run autoconf
+            steps.ShellCommand(
+                name="autoconf",
+                workdir="build/src",
+                command=["./autogen.sh"],
+                doStepIf=self.need_configure,
+                haltOnFailure=True,
+                ),
+            # configure source
+            steps.ShellCommand(
+                name="configure",
+                workdir="build/src",
+                env=self.env,
+                command=["./configure"] + self.configure_args,
+                doStepIf=self.need_configure,
+                haltOnFailure=True,
+                ),
+            ]
+        if self.incremental:
+            res += [
+                # record fingerprint of successful configure
+                steps.ShellCommand(
+                    name="save fingerprint",
+                    workdir="build/src",
+                    command=["sh", "-c", util.Interpolate(
+                            "echo %(prop:fingerprint)s > .dbb-fingerprint")],
+                    doStepIf=self.need_configure,
+                    haltOnFailure=True,
+                    ),
+                ]
+        return res
+
+    def ccache_zero(self):
+        if not self.config.ccache['enabled']:
+            return []
+        return [
+            # zero compiler cache statistics and set its size
+            steps.ShellCommand(
+                name="ccache zero",
+                command=["ccache", "-z", "-M", self.config.ccache['max_size']],
+                env=self.env,
+                ),
+            ]
+
+    def ccache_report(self):
+        if not self.config.ccache['enabled']:
+            return []
+        return [
+            # publish compiler cache hit rate as build properties
+            steps.SetPropertyFromCommand(
+                name="ccache stats",
+                command=["ccache", "-s"],
+                extract_fn=ccache_stats,
+                env=self.env,
+                ),
+            ]
+
+    def compile(self):
+        return self.ccache_zero() + [
+            # compile source, with each slave's `parallel_jobs`
+            steps.Compile(
+                name="build",
+                workdir="build/src",
+                env=self.env,
+                command=["make", "V=1",
+                         util.Interpolate("-j%(prop:parallel_jobs:-1)s")],
+                warningPattern="^Warning: ",
+                haltOnFailure=True,
+                ),
+            ] + self.ccache_report() + [
+            # make setuid
+            steps.ShellCommand(
+                name="setuid",
+                workdir="build/src",
+                command=["sudo", "make", "setuid"],
+                haltOnFailure=True,
+                ),
+            ]
+
+    def test(self):
+        if self.config.test_shards > 1:
+            return self.sharded_test()
+        return [
+            # regression tests
+            steps.ShellCommand(
+                name="test",
+                workdir="build/src",
+                env=dict(
+                    DEBUG='5',
+                    MSGD_OPTS='-s',
+                    ),
+                usePTY=True,
+                command=["bash", "-c",
+                         ". ../scripts/rip-environment; runtests -v"],
+                haltOnFailure=True,
+                ),
+            ]
+
+    def sharded_test(self):
+        return [
+            # list regression tests
+            steps.SetPropertyFromCommand(
+                name="list tests",
+                workdir="build/src",
+                command=["sh", "-c",
+                         "find ../tests -type f \\( -name test.hal "
+                         "-o -name test.sh -o -name test \\) "
+                         "| xargs -n1 dirname"],
+                extract_fn=test_dirs,
+                haltOnFailure=True,
+                ),
+            # regression tests, in parallel shards
+            ShardedTests(
+                name="test",
+                workdir="build/src",
+                shards=self.config.test_shards,
+                durations_file=self.config.test_durations_file,
+                durations_key=self.builder['name'],
+                env=dict(
+                    DEBUG='5',
+                    MSGD_OPTS='-s',
+                    ),
+                usePTY=True,
+                haltOnFailure=True,
+                ),
+            ]
+
+    def factory(self):
+        factory = util.BuildFactory()
+        for step in self.checkout() + self.configure() + self.compile() + \
+                self.test():
+            factory.addStep(step)
+        return factory
@@ -0,0 +1,150 @@
+import os, re, sys, time, pipes, subprocess
+
+class git_mirror(object):
+    """
+    Bare mirror of the configured git repo in the tree, kept up to
+    date by the master's GitPoller and by builds, and used by the
+    builds' Git steps as a reference repository
+    """
+    refspec = '+refs/heads/*:refs/heads/*'
+
+    # Build trees borrow the mirror's objects through alternates, so
+    # it must never prune objects, e.g. after a force push
+    git_config = [('gc.auto', '0'), ('gc.pruneExpire', 'never')]
+
+    def __init__(self, config):
+        self.config = config
+        self.settings = config.git_mirror
+
+    @property
+    def enabled(self):
+        return self.settings['enabled']
+
+    @property
+    def name(self):
+        """Mirror directory name, from the repo URL"""
+        name = re.split(r'[/:]', self.config.git_repo.rstrip('/'))[-1]
+        name = re.sub(r'[^a-zA-Z0-9_.-]+', '-', re.sub(r'\.git$', '', name))
+        return '%s.git' % (name or 'repo')
+
+    @property
+    def path(self):
+        """Mirror path in this tree"""
+        return os.path.join(self.config.base_dir, 'git-mirror', self.name)
+
+    @property
+    def slave_path(self):
+        """Mirror path as seen by slaves in their containers"""
+        return os.path.join(self.config.container_dir, 'git-mirror',
+                            self.name)
+
+    def configure_script(self, path):
+        """Shell commands setting the mirror's git config, if needed"""
+        q = pipes.quote
+        return ' && '.join([
+                'test "$(git --git-dir=%(path)s config %(key)s)" = %(val)s '
+                '|| git --git-dir=%(path)s config %(key)s %(val)s' % dict(
+                    path = q(path), key = q(key), val = q(val))
+                for key, val in self.git_config ])
+
+    def refresh_script(self, path=None):
+        """
+        Shell script creating the mirror at `path` (default as seen by
+        slaves) if needed and fetching into it, unless it was fetched
+        within the refresh interval; runs are serialized with flock
+        """
+        path = path or self.slave_path
+        return (
+            'mkdir -p %(parent)s && exec 9>%(lock)s && flock 9 && '
+            '{ test -d %(path)s/objects || git init -q --bare %(path)s; } && '
+            '%(configure)s && '
+            'if test -f %(path)s/FETCH_HEAD && test $(( $(date +%%s) - '
+            '$(stat -c %%Y %(path)s/FETCH_HEAD) )) -lt %(interval)d; then '
+            'echo "Mirror %(path)s is up to date"; else '
+            'git --git-dir=%(path)s fetch --prune %(repo)s %(refspec)s; fi'
+            ) % dict(
+            parent = pipes.quote(os.path.dirname(path)),
+            lock = pipes.quote(path + '.lock'),
+            path = pipes.quote(path),
+            configure = self.configure_script(path),
+            interval = self.settings['refresh_interval'],
+            repo = pipes.quote(self.config.git_repo),
+            refspec = pipes.quote(self.refspec),
+            )
+
+    @property
+    def poller_gitbin(self):
+        """
+        Path of a git wrapper for the master's GitPoller, holding the
+        mirror's lock like builds' refreshes do; written on demand
+        """
+        gitbin = self.path + '.gitbin'
+        content = (
+            '#!/bin/sh\n'
+            '# git for the GitPoller, serialized with builds\' refreshes of\n'
+            '# the mirror; generated by lib/python/dbb/git_mirror.py\n'
+            'exec 9>%(lock)s && flock 9 || exit 1\n'
+            'if test -d %(path)s/objects; then %(configure)s; fi\n'
+            'exec git "$@"\n') % dict(
+            lock = pipes.quote(self.path + '.lock'),
+            path = pipes.quote(self.path),
+            configure = self.configure_script(self.path))
+        if not os.path.isdir(os.path.dirname(gitbin)):
+            os.makedirs(os.path.dirname(gitbin))
+        if os.path.exists(gitbin):
+            with open(gitbin, 'r') as f:
+                if f.read() == content:
+                    return gitbin
+        with open(gitbin + '.tmp', 'w') as f:
+            f.write(content)
+        os.chmod(gitbin + '.tmp', 0755)
+        os.rename(gitbin + '.tmp', gitbin)
+        return gitbin
+
+    def refresh(self):
+        """Create or refresh the mirror in this tree"""
+        if subprocess.call(['sh', '-c', self.refresh_script(self.path)]):
+            sys.stderr.write("Error:  refreshing git mirror %s failed\n" % \
+                                 self.path)
+            sys.exit(1)
+
+    def git(self, *args):
+        return subprocess.check_output(
+            ['git', '--git-dir=%s' % self.path] + list(args))
+
+    def status(self):
+        """Mirror status, or None if it doesn't exist"""
+        if not os.path.isdir(os.path.join(self.path, 'objects')):
+            return None
+        size = 0
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            size += sum([ os.path.getsize(os.path.join(dirpath, f))
+                          for f in filenames ])
+        fetch_head = os.path.join(self.path, 'FETCH_HEAD')
+        refs = self.git('for-each-ref', '--format=%(refname)').split()
+        return dict(
+            path = self.path,
+            size_mb = round(size / 1024.0 / 1024.0, 1),
+            last_fetch_age = (time.time() - os.path.getmtime(fetch_head))
+            if os.path.exists(fetch_head) else None,
+            branches = len([ r for r in refs if r.startswith('refs/heads/') ]),
+            poller_refs = len([ r for r in refs
+                                if r.startswith('refs/buildbot/') ]),
+            )
+
+    def dump(self):
+        print "Git mirror:"
+        if not self.enabled:
+            print "    (disabled)"
+            return
+        status = self.status()
+        if status is None:
+            print "    %s (not created)" % self.path
+            return
+        age = status['last_fetch_age']
+        print "    Path:  %s" % status['path']
+        print "    Size:  %.1f MB" % status['size_mb']
+        print "    Last fetch:  %s" % \
+            ('%d seconds ago' % age if age is not None else 'never')
+        print "    Branches:  %d; poller refs:  %d" % \
+            (status['branches'], status['poller_refs'])
@@ -1,31 +1,104 @@
-import os, sys, re, subprocess
+import os, sys, re, subprocess, time
 
 class init(object):
     def __init__(self, config):
         self.config = config
 
     def init(self):
-        """Initialize all container run-time configuration."""
-        self.ssh_authorized_keys()
-        self.buildbot_master()
-        self.buildbot_slave()
+        """
+        Initialize all container run-time configuration.  Each step
+        is skipped when its results are already in place, so this is
+        safe to re-run.
+        """
+        total = 0.0
+        for name, step in (('ssh keys', self.ssh_authorized_keys),
+                           ('master', self.buildbot_master),
+                           ('slave', self.buildbot_slave)):
+            start = time.time()
+            step()
+            elapsed = time.time() - start
+            total += elapsed
+            sys.stderr.write("    (%s:  %.2fs)\n" % (name, elapsed))
+        sys.stderr.write("*** Initialization complete in %.2fs\n" % total)
+
+    def write_if_changed(self, path, content):
+        """Write `content` to `path` unless already there; return True
+        if written"""
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                if f.read() == content:
+                    return False
+        with open(path, 'w') as f:
+            f.write(content)
+        return True
 
     def ssh_authorized_keys(self):
-        sys.stderr.write("*** Installing SSH authorized_keys\n")
-        with open("/home/docker/.ssh/authorized_keys", 'w') as f:
-            for keystr in self.config.maintainer_keys:
-                f.write(re.sub(r'\n', '', keystr) + "\n")
+        content = ''.join([ re.sub(r'\n', '', keystr) + "\n"
+                            for keystr in self.config.maintainer_keys ])
+        if self.write_if_changed("/home/docker/.ssh/authorized_keys", content):
+            sys.stderr.write("*** Installed SSH authorized_keys\n")
+        else:
+            sys.stderr.write("*** SSH authorized_keys up to date\n")
+
+    def master_is_valid(self):
+        """The master directory has been created and its database
+        initialized"""
+        return all([ os.path.exists(os.path.join(self.config.master_dir, f))
+                     for f in ('buildbot.tac', 'state.sqlite') ])
 
     def buildbot_master(self):
         if self.config.master_host != self.config.host:
             sys.stderr.write("*** Container is not Buildbot master; not initializing\n")
             return
+        if self.master_is_valid():
+            sys.stderr.write("*** Buildbot master already initialized\n")
+            return
         cmd = [ "buildbot", "create-master", self.config.master_dir ]
         sys.stderr.write("*** Initializing Buildbot master:  %s\n" % \
                              ' '.join(cmd))
         subprocess.call(cmd)
 
+    @property
+    def slave_info(self):
+        """Contents of the slave's `info/` files"""
+        return dict(
+            admin = "%s <%s>\n" % \
+                (self.config.maintainer_name, self.config.maintainer_email),
+            host = "%s, from: %s\n" % \
+                (self.config.slave.name, self.config.slave.base_image),
+            )
+
+    @property
+    def slave_tac(self):
+        return os.path.join(self.config.slave.dir, 'buildbot.tac')
+
+    # `buildslave` matches this line to recognize a slave directory
+    slave_tac_marker = "Application('buildslave')"
+
+    def slave_is_valid(self):
+        """
+        The slave directory has a buildslave `buildbot.tac` and its info
+        files are current; the tracked tac reads its master and
+        credentials from the config, so they needn't be checked
+        """
+        if not os.path.exists(self.slave_tac):
+            return False
+        with open(self.slave_tac, 'r') as f:
+            if self.slave_tac_marker not in f.read():
+                return False
+        for name, content in self.slave_info.items():
+            path = os.path.join(self.config.slave.dir, 'info', name)
+            if not os.path.exists(path):
+                return False
+            with open(path, 'r') as f:
+                if f.read() != content:
+                    return False
+        return True
+
     def buildbot_slave(self):
+        if self.slave_is_valid():
+            sys.stderr.write("*** Buildbot slave already initialized\n")
+            return
         cmd = [ "buildslave", "create-slave", self.config.slave.dir,
                 self.config.master_host, self.config.hostname,
                 self.config.slave.password ]
@@ -33,13 +106,10 @@ class init(object):
                              ' '.join(cmd))
         subprocess.call(cmd)
 
-        admin = "%s <%s>\n" % \
-            (self.config.maintainer_name, self.config.maintainer_email)
-        host = "%s, from: %s\n" % \
-            (self.config.slave.name, self.config.slave.base_image)
-        sys.stderr.write("    Admin:  %s    Description:  %s" % (admin, host))
+        info = self.slave_info
+        sys.stderr.write("    Admin:  %s    Description:  %s" % \
+                             (info['admin'], info['host']))
 
-        with open(os.path.join(self.config.slave.dir, 'info/admin'), 'w') as f:
-            f.write(admin)
-        with open(os.path.join(self.config.slave.dir, 'info/host'), 'w') as f:
-            f.write(host)
+        for name, content in info.items():
+            self.write_if_changed(
+                os.path.join(self.config.slave.dir, 'info', name), content)
@@ -0,0 +1,231 @@
+# Build farm metrics
+#
+# Counters, gauges and histograms kept in a process-wide registry,
+# `metrics`, fed by the master's status receiver and the latent
+# slaves, and rendered in the Prometheus text format.  Parsing and
+# summarizing the rendered text, for `dbb --stats`, is here too; this
+# module doesn't need buildbot or twisted.
+
+import re, threading, time
+
+class metric(object):
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple([ str(labels.get(l, '')) for l in self.labels ])
+
+    def label_str(self, key, extra=()):
+        pairs = zip(self.labels, key) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join([
+                '%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"'))
+                for k, v in pairs ])
+
+    def render(self):
+        lines = [ '# HELP %s %s' % (self.name, self.help),
+                  '# TYPE %s %s' % (self.name, self.type) ]
+        with self.lock:
+            for key in sorted(self.values):
+                lines.extend(self.render_value(key, self.values[key]))
+        return lines
+
+    def render_value(self, key, value):
+        return [ '%s%s %s' % (self.name, self.label_str(key), repr(value)) ]
+
+class counter(metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class gauge(metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class histogram(metric):
+    type = 'histogram'
+    # Seconds, from quick steps to droplet boots and long test runs
+    default_buckets = (0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800,
+                       3600)
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        super(histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total, n = self.values.get(
+                key, ([0] * len(self.buckets), 0.0, 0))
+            counts = [ c + (value <= b) for c, b in zip(counts, self.buckets) ]
+            self.values[key] = (counts, total + value, n + 1)
+
+    def render_value(self, key, value):
+        counts, total, n = value
+        lines = [ '%s_bucket%s %d' % (self.name,
+                                      self.label_str(key, [('le', repr(b))]),
+                                      c)
+                  for b, c in zip(self.buckets, counts) ]
+        lines += [
+            '%s_bucket%s %d' % (self.name,
+                                self.label_str(key, [('le', '+Inf')]), n),
+            '%s_sum%s %s' % (self.name, self.label_str(key), repr(total)),
+            '%s_count%s %d' % (self.name, self.label_str(key), n),
+            ]
+        return lines
+
+class registry(object):
+    """Metrics by name; asking again for a metric returns the same one"""
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+
+    def get(self, cls, name, help, labels=(), **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, help, labels, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, help, labels=()):
+        return self.get(counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self.get(gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), **kwargs):
+        return self.get(histogram, name, help, labels, **kwargs)
+
+    def render(self):
+        """Prometheus text format of all metrics"""
+        self.gauge('dbb_uptime_seconds', 'Seconds since metrics started'
+                   ).set(time.time() - self.start_time)
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return '\n'.join(lines) + '\n'
+
+metrics = registry()
+
+# The farm's metrics, shared by their feeds and the summary
+step_duration = metrics.histogram(
+    'dbb_step_duration_seconds', 'Build step durations',
+    ('builder', 'step'))
+build_duration = metrics.histogram(
+    'dbb_build_duration_seconds', 'Build durations', ('builder', 'result'))
+builds = metrics.counter(
+    'dbb_builds_total', 'Finished builds', ('builder', 'result'))
+queue_wait = metrics.histogram(
+    'dbb_queue_wait_seconds',
+    'Time from build request to build start', ('builder',))
+substantiation = metrics.histogram(
+    'dbb_substantiation_seconds',
+    'Time from latent slave start to each phase', ('slave', 'phase'))
+slave_busy = metrics.counter(
+    'dbb_slave_busy_seconds_total', 'Seconds slaves spent building',
+    ('slave',))
+slave_running = metrics.gauge(
+    'dbb_slave_builds_running', 'Builds running on slaves', ('slave',))
+slave_parallel_jobs = metrics.gauge(
+    'dbb_slave_parallel_jobs', 'Configured parallel_jobs of slaves',
+    ('slave',))
+
+sample_re = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)$')
+label_re = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+def parse(text):
+    """Parse Prometheus text into a list of `(name, labels, value)`"""
+    res = []
+    for line in text.splitlines():
+        m = sample_re.match(line.strip())
+        if m is None:
+            continue
+        name, labels, value = m.groups()
+        labels = dict([ (k, v.replace('\\"', '"').replace('\\\\', '\\'))
+                        for k, v in label_re.findall(labels or '') ])
+        res.append((name, labels, float(value)))
+    return res
+
+def histograms(samples, name, labels):
+    """Collect histogram samples into `{label values: (count, sum,
+    [(le, count), ...])}`"""
+    res = {}
+    for sample, l, value in samples:
+        if not sample.startswith(name + '_'):
+            continue
+        key = tuple([ l.get(k, '') for k in labels ])
+        count, total, buckets = res.get(key, (0, 0.0, []))
+        if sample == name + '_count':
+            count = value
+        elif sample == name + '_sum':
+            total = value
+        elif sample == name + '_bucket':
+            buckets.append((float(l['le']), value))
+        res[key] = (count, total, buckets)
+    return res
+
+def quantile(q, count, buckets):
+    """Upper bound of the bucket holding the `q` quantile"""
+    for le, c in sorted(buckets):
+        if count and c >= q * count:
+            return le
+    return float('inf')
+
+def summary(samples, out):
+    """Write a summary of parsed metrics samples"""
+    def seconds(s):
+        return '%7.1fs' % s if s != float('inf') else '      -'
+
+    for title, name, labels in (
+        ('Step durations', step_duration.name, ('builder', 'step')),
+        ('Queue wait', queue_wait.name, ('builder',)),
+        ('Latent slave substantiation', substantiation.name,
+         ('slave', 'phase'))):
+        hist = histograms(samples, name, labels)
+        out.write('%s:\n' % title)
+        if not hist:
+            out.write('    (none)\n')
+        for key in sorted(hist):
+            count, total, buckets = hist[key]
+            out.write('    %-50s %5d  mean %s  p95 <= %s\n' % \
+                          (' / '.join(key), count,
+                           seconds(total / count if count else 0),
+                           seconds(quantile(0.95, count, buckets))))
+
+    uptime = ([ v for n, l, v in samples if n == 'dbb_uptime_seconds' ]
+              + [0])[0]
+    slaves = {}
+    for name, labels, value in samples:
+        for metric, field in ((slave_busy.name, 'busy'),
+                              (slave_running.name, 'running'),
+                              (slave_parallel_jobs.name, 'jobs')):
+            if name == metric:
+                slaves.setdefault(labels['slave'], {})[field] = value
+    out.write('Slave utilisation (over %d minutes):\n' % (uptime // 60))
+    if not slaves:
+        out.write('    (none)\n')
+    for slave in sorted(slaves):
+        s = slaves[slave]
+        out.write('    %-40s busy %5.1f%%  running %d  parallel_jobs %s\n' % \
+                      (slave,
+                       100.0 * s.get('busy', 0) / uptime if uptime else 0,
+                       s.get('running', 0),
+                       '%d' % s['jobs'] if 'jobs' in s else '-'))
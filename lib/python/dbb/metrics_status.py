@@ -0,0 +1,79 @@
+# Buildbot feeds and web endpoint for dbb.metrics
+
+from twisted.web import resource
+from buildbot.status.base import StatusReceiverMultiService
+from buildbot.status.results import Results
+from dbb import metrics
+
+
+class MetricsResource(resource.Resource):
+    """Serve the metrics registry in the Prometheus text format"""
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        return metrics.metrics.render()
+
+
+class MetricsStatus(StatusReceiverMultiService):
+    """Feed step and build durations, queue wait and slave
+    utilisation from build status"""
+
+    def __init__(self, slave_configs=[]):
+        StatusReceiverMultiService.__init__(self)
+        self.watched = []
+        for sc in slave_configs:
+            for name in sc.worker_names:
+                metrics.slave_parallel_jobs.set(sc.parallel_jobs, slave=name)
+
+    def setServiceParent(self, parent):
+        StatusReceiverMultiService.setServiceParent(self, parent)
+        self.master_status = self.parent
+        self.master_status.subscribe(self)
+        self.master = self.master_status.master
+
+    def disownServiceParent(self):
+        self.master_status.unsubscribe(self)
+        self.master_status = None
+        for w in self.watched:
+            w.unsubscribe(self)
+        self.watched = []
+        return StatusReceiverMultiService.disownServiceParent(self)
+
+    def builderAdded(self, name, builder):
+        # Subscribe to the builder's builds
+        self.watched.append(builder)
+        return self
+
+    def submitted_at(self, builderName, build):
+        """Submit time of the oldest request merged into the build"""
+        builder = self.master.botmaster.builders.get(builderName)
+        for b in getattr(builder, 'building', []):
+            if b.build_status is build:
+                return min([ r.submittedAt for r in b.requests ])
+        return None
+
+    def buildStarted(self, builderName, build):
+        metrics.slave_running.inc(slave=build.getSlavename())
+        submitted = self.submitted_at(builderName, build)
+        if submitted is not None:
+            metrics.queue_wait.observe(
+                max(0, build.getTimes()[0] - submitted), builder=builderName)
+        # Subscribe to the build's steps
+        return self
+
+    def stepFinished(self, build, step, results):
+        start, end = step.getTimes()
+        if start is not None and end is not None:
+            metrics.step_duration.observe(
+                end - start, builder=build.getBuilder().getName(),
+                step=step.getName())
+
+    def buildFinished(self, builderName, build, results):
+        start, end = build.getTimes()
+        slave = build.getSlavename()
+        metrics.builds.inc(builder=builderName, result=Results[results])
+        metrics.build_duration.observe(
+            end - start, builder=builderName, result=Results[results])
+        metrics.slave_busy.inc(end - start, slave=slave)
+        metrics.slave_running.inc(-1, slave=slave)
@@ -0,0 +1,94 @@
+import sys, time, threading
+from multiprocessing.pool import ThreadPool
+from dbb.container import container
+
+class prefixed_stream(object):
+    """
+    Stream wrapper that prefixes each line written from a worker
+    thread with that thread's host name; other threads write through
+    unchanged
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def start(self, prefix):
+        self.local.prefix = prefix
+        self.local.buf = ''
+
+    def finish(self):
+        if getattr(self.local, 'buf', ''):
+            self.write('\n')
+        self.local.prefix = None
+
+    def write(self, s):
+        prefix = getattr(self.local, 'prefix', None)
+        if prefix is None:
+            with self.lock:
+                self.stream.write(s)
+            return
+        lines = (self.local.buf + s).split('\n')
+        self.local.buf = lines.pop()
+        with self.lock:
+            for line in lines:
+                self.stream.write('%s%s\n' % (prefix, line))
+
+    def flush(self):
+        with self.lock:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class parallel(object):
+    """Run a container operation across several hosts with a bounded
+    worker pool"""
+    def __init__(self, config, hosts, jobs=4):
+        self.config = config
+        self.hosts = hosts
+        self.jobs = max(1, min(jobs, len(hosts)))
+        # One Docker client shared by all hosts' containers
+        self.client = container(config).c
+
+    def _run_host(self, host, operation):
+        start = time.time()
+        sys.stdout.start('[%s] ' % host)
+        sys.stderr.start('[%s] ' % host)
+        status = 0
+        try:
+            operation(container(self.config.for_host(host), self.client))
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else int(bool(e.code))
+        except Exception as e:
+            sys.stderr.write("Exception:  %s\n" % e)
+            status = 1
+        finally:
+            sys.stdout.finish()
+            sys.stderr.finish()
+        return (host, time.time() - start, status)
+
+    def run(self, operation):
+        """
+        Run `operation(container)` for each host; print a summary
+        table and return the number of failed hosts
+        """
+        orig_stdout, orig_stderr = sys.stdout, sys.stderr
+        sys.stdout = prefixed_stream(orig_stdout)
+        sys.stderr = prefixed_stream(orig_stderr)
+        pool = ThreadPool(self.jobs)
+        try:
+            results = pool.map(
+                lambda host: self._run_host(host, operation), self.hosts)
+        finally:
+            pool.close()
+            pool.join()
+            sys.stdout, sys.stderr = orig_stdout, orig_stderr
+
+        width = max([ len(h) for h in self.hosts ] + [4])
+        sys.stderr.write("\n%-*s  %9s  %s\n" % (width, "Host", "Time", "Status"))
+        for host, duration, status in results:
+            sys.stderr.write("%-*s  %8.1fs  %s\n" % \
+                                 (width, host, duration,
+                                  'ok' if status == 0 else 'failed (%s)' % status))
+        return len([ r for r in results if r[2] != 0 ])
@@ -0,0 +1,119 @@
+import socket, sys, time
+
+class readiness(object):
+    """
+    Wait for a started container's supervisord programs to come up
+    and their ports to accept connections
+    """
+    # Ports each program listens on once it's up
+    program_ports = dict(
+        buildmaster = [8010, 9989],
+        buildworker = [],
+        sshd = [22],
+        )
+    # supervisord states that won't come right without intervention
+    failed_states = ('FATAL', 'EXITED', 'STOPPED', 'UNKNOWN')
+
+    poll_initial = 0.1
+    poll_max = 2.0
+    tail_bytes = 2000
+
+    def __init__(self, container):
+        self.container = container
+        self.config = container.config
+        self.c = container.c
+
+    @property
+    def programs(self):
+        """Programs to wait for; only the master runs the buildmaster"""
+        programs = ['buildworker', 'sshd']
+        if self.config.master_host == self.config.host:
+            programs.insert(0, 'buildmaster')
+        return programs
+
+    def supervisorctl(self, *args):
+        e = self.c.exec_create(self.config.hostname,
+                               ['sudo', '-n', 'supervisorctl'] + list(args))
+        return self.c.exec_start(e['Id'])
+
+    def status(self):
+        """Map supervisord program names to states"""
+        res = {}
+        for line in self.supervisorctl('status').splitlines():
+            fields = line.split()
+            if len(fields) >= 2:
+                res[fields[0]] = fields[1]
+        return res
+
+    def port_open(self, ip, port):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(0.5)
+        try:
+            s.connect((ip, port))
+            return True
+        except socket.error:
+            return False
+        finally:
+            s.close()
+
+    def ip_address(self):
+        self.container.invalidate()
+        info = self.container.container()
+        if info is None or not info['State']['Running']:
+            return None
+        return info['NetworkSettings']['IPAddress']
+
+    def log_tail(self, program):
+        return ''.join([
+                self.supervisorctl('tail', '-%d' % self.tail_bytes,
+                                   program, stream)
+                for stream in ('stdout', 'stderr') ])
+
+    def fail(self, program, why):
+        sys.stderr.write("Error:  %s %s; log tail:\n" % (program, why))
+        if program is not None:
+            sys.stderr.write(self.log_tail(program))
+        sys.exit(1)
+
+    def wait(self, timeout=60):
+        """
+        Poll until all programs are running and listening, backing
+        off between polls; report each program's time to ready, or
+        exit with the log tail of a program that failed or didn't
+        come up in `timeout` seconds
+        """
+        start = time.time()
+        pending = list(self.programs)
+        delay = self.poll_initial
+        while True:
+            ip = self.ip_address()
+            if ip is None:
+                sys.stderr.write("Error:  container exited while starting\n")
+                sys.exit(1)
+            try:
+                status = self.status()
+            except Exception:
+                # supervisord may not be accepting connections yet
+                status = {}
+            for program in list(pending):
+                state = status.get(program)
+                if state in self.failed_states:
+                    self.fail(program, "failed (%s)" % state)
+                if state != 'RUNNING':
+                    continue
+                if not all([ self.port_open(ip, p)
+                             for p in self.program_ports.get(program, []) ]):
+                    continue
+                pending.remove(program)
+                sys.stderr.write("%s ready in %.1fs\n" % \
+                                     (program, time.time() - start))
+            if not pending:
+                sys.stderr.write("Container ready in %.1fs\n" % \
+                                     (time.time() - start))
+                return
+            if time.time() - start > timeout:
+                program = pending[0]
+                self.fail(program, "not ready after %ds (%s)" % \
+                              (timeout, status.get(program, 'not started')))
+            time.sleep(delay)
+            delay = min(delay * 2, self.poll_max)
@@ -1,6 +1,53 @@
-import os
+import os, re
 from io import BytesIO
 
+class compiled_template(object):
+    """
+    A template file, read and parsed once
+
+    Rendering is a single `%` substitution over the whole file, with
+    results cached by the values of the keys the template uses.
+    """
+    # Match `%(key)` substitutions, skipping `%%` escapes
+    key_re = re.compile(r'%(?:%|\((\w+)\))')
+    _cache = {}
+
+    @classmethod
+    def load(cls, path):
+        """Return the compiled template for path, reloading if modified"""
+        mtime = os.path.getmtime(path)
+        t = cls._cache.get(path)
+        if t is None or t.mtime != mtime:
+            t = cls._cache[path] = cls(path, mtime)
+        return t
+
+    def __init__(self, path, mtime):
+        self.path = path
+        self.mtime = mtime
+        with open(path, 'r') as f:
+            self.text = f.read()
+        self.keys = frozenset(
+            [ k for k in self.key_re.findall(self.text) if k ])
+        self.rendered = {}
+
+    def unknown_keys(self, subs):
+        """Keys used in the template but missing from subs"""
+        return sorted(self.keys.difference(subs))
+
+    def unused_keys(self, subs):
+        """Keys in subs not used in the template"""
+        return sorted(set(subs).difference(self.keys))
+
+    def render(self, subs):
+        unknown = self.unknown_keys(subs)
+        if unknown:
+            raise RuntimeError("Template '%s' has unknown keys:  %s" % \
+                                   (self.path, ', '.join(unknown)))
+        key = tuple([ (k, subs[k]) for k in sorted(self.keys) ])
+        if key not in self.rendered:
+            self.rendered[key] = self.text % subs
+        return self.rendered[key]
+
 class template(object):
     def __init__(self, config):
         self.config = config
@@ -13,10 +60,27 @@ class template(object):
     def template(self):
         return os.path.join(self.config.lib_dir, self.template_name)
 
+    @property
+    def compiled(self):
+        return compiled_template.load(self.template)
+
+    @property
+    def all_subs(self):
+        """Config substitutions plus this template's own"""
+        subs = self.config.subs.copy()
+        subs.update(self.subs)
+        return subs
+
     @property
     def file(self):
         return BytesIO(self.__str__().encode('utf-8'))
 
+    def check(self):
+        """Return (unknown, unused) substitution keys"""
+        subs = self.all_subs
+        return (self.compiled.unknown_keys(subs),
+                self.compiled.unused_keys(subs))
+
     def dump(self):
         print self
 
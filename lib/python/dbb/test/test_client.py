@@ -0,0 +1,52 @@
+# Shared Docker client and its API version cache, against a fake
+# Docker daemon
+
+import json, os, shutil, tempfile
+
+from twisted.trial import unittest
+
+from dbb import client
+from dbb.bench.fake_docker import fake_docker
+
+class fake_config(object):
+    def __init__(self, docker_api_version_file):
+        self.docker_api_version_file = docker_api_version_file
+
+class ClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = fake_docker(images=2, containers=2, log_lines=1)
+        self.addCleanup(self.server.stop)
+        self.base_url = 'tcp://127.0.0.1:%d' % self.server.port
+        self.patch(os, 'environ', dict(os.environ))
+        for var in ('DOCKER_TLS_VERIFY', 'DOCKER_CERT_PATH'):
+            os.environ.pop(var, None)
+        os.environ['DOCKER_HOST'] = self.base_url
+        self.patch(client, '_clients', {})
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.version_file = os.path.join(self.dir, 'versions.json')
+        self.config = fake_config(self.version_file)
+
+    def cached_versions(self):
+        with open(self.version_file, 'r') as f:
+            return json.load(f)
+
+    def test_version_cached(self):
+        c = client.client(self.config)
+        self.assertEqual(c.api_version, '1.24')
+        self.assertEqual(self.cached_versions(), {self.base_url : '1.24'})
+        self.assertIdentical(client.client(self.config), c)
+
+    def test_stale_cached_version_renegotiated(self):
+        client.write_version(self.version_file, self.base_url, '1.30')
+        c = client.client(self.config)
+        self.assertEqual(c.api_version, '1.30')
+        self.assertEqual(c.info()['Images'], 2)
+        self.assertEqual(c.api_version, '1.24')
+        self.assertEqual(self.cached_versions(), {self.base_url : '1.24'})
+
+    def test_read_only_cache(self):
+        self.config.docker_api_version_file = \
+            os.path.join(self.dir, 'missing', 'versions.json')
+        c = client.client(self.config)
+        self.assertEqual(c.info()['Images'], 2)
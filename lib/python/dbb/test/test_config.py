@@ -0,0 +1,38 @@
+# Config loading and its pickle cache
+
+import os, shutil, tempfile
+
+from twisted.trial import unittest
+
+from dbb.config import config
+
+class ConfigCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.config_file = os.path.join(self.dir, 'config.yaml')
+        with open(self.config_file, 'w') as f:
+            f.write('slaves:\n  s1:\n    password: x\n')
+        self.cache_file = os.path.join(self.dir, '.config.yaml.pickle')
+        self.patch(config, '_loaded', {})
+
+    def load(self):
+        config._loaded.clear()
+        return config.load(self.config_file)
+
+    def test_cache_written(self):
+        self.assertEqual(self.load()['slaves'].keys(), ['s1'])
+        self.assertTrue(os.path.exists(self.cache_file))
+        self.assertEqual(self.load()['slaves'].keys(), ['s1'])
+
+    def test_corrupt_cache(self):
+        self.load()
+        with open(self.cache_file, 'rb') as f:
+            good = f.read()
+        for bad in (good[:len(good) // 2], '', 'garbage',
+                    'cnonexistent_module\nthing\n.', '(lp0\n0g1\n.'):
+            with open(self.cache_file, 'wb') as f:
+                f.write(bad)
+            self.assertEqual(self.load()['slaves'].keys(), ['s1'])
+            with open(self.cache_file, 'rb') as f:
+                self.assertEqual(f.read(), good)
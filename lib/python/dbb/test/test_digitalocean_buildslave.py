@@ -0,0 +1,136 @@
+# DropletIndex and DigitalOceanLatentBuildSlave against a fake
+# DigitalOcean API
+
+import time
+
+import digitalocean
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from buildbot import interfaces
+
+import digitalocean_buildslave
+from digitalocean_buildslave import DropletIndex, DigitalOceanLatentBuildSlave
+from dbb.bench.fake_digitalocean import fake_digitalocean
+
+class fake_api_test(unittest.TestCase):
+    """Point python-digitalocean at a fake API with a few droplets"""
+    def setUp(self):
+        self.server = fake_digitalocean(droplets=5, images=3)
+        self.addCleanup(self.server.stop)
+        base_init = digitalocean.baseapi.BaseAPI.__init__
+        url = self.server.url + '/v2/'
+        def init(api, *args, **kwargs):
+            base_init(api, *args, **kwargs)
+            api.end_point = url
+        self.patch(digitalocean.baseapi.BaseAPI, '__init__', init)
+        self.now = 1000.0
+        self.patch(digitalocean_buildslave.time, 'time', lambda: self.now)
+        self.index = DropletIndex('token')
+
+    def requests(self, name):
+        return self.server.requests().get(name, 0)
+
+class DropletIndexTest(fake_api_test):
+    def test_droplets_cached_for_ttl(self):
+        self.assertEqual(len(self.index.droplets()), 5)
+        self.now += self.index.droplet_ttl - 1
+        self.index.droplets()
+        self.assertEqual(self.requests('list_droplets'), 1)
+        self.now += 2
+        self.index.droplets()
+        self.assertEqual(self.requests('list_droplets'), 2)
+
+    def test_images_cached_for_ttl(self):
+        self.assertEqual(self.index.image_id('image-2'), 1002)
+        self.assertEqual(self.index.image_id('image-9'), None)
+        self.assertEqual(self.requests('list_images'), 1)
+        self.now += self.index.image_ttl + 1
+        self.index.image_id('image-2')
+        self.assertEqual(self.requests('list_images'), 2)
+
+    def test_invalidate(self):
+        droplet = self.index.droplet_by_name('droplet-3')
+        self.assertEqual(droplet.id, 3)
+        droplet.destroy()
+        # Still cached
+        self.assertEqual(self.index.droplet_by_name('droplet-3').id, 3)
+        self.index.invalidate()
+        self.assertEqual(self.index.droplet_by_name('droplet-3'), None)
+        self.assertEqual(self.requests('list_droplets'), 2)
+
+    def test_droplet_by_id(self):
+        self.assertEqual(self.index.droplet_by_id(2).name, 'droplet-2')
+        self.index.droplet_by_id(2)
+        self.assertEqual(self.requests('get_droplet'), 2)
+        self.assertEqual(self.requests('list_droplets'), 0)
+
+    def test_droplet_by_id_missing(self):
+        self.assertEqual(self.index.droplet_by_id(99), None)
+
+    def test_shared_per_token(self):
+        self.patch(DropletIndex, '_indexes', {})
+        self.assertIdentical(DropletIndex.get('a'), DropletIndex.get('a'))
+        self.assertNotIdentical(DropletIndex.get('a'), DropletIndex.get('b'))
+
+class PollingTest(fake_api_test):
+    def setUp(self):
+        fake_api_test.setUp(self)
+        self.clock = task.Clock()
+        self.patch(digitalocean_buildslave, 'reactor', self.clock)
+        self.slave = DigitalOceanLatentBuildSlave(
+            'slave', 'password', 'droplet-1', 'token', 'nyc3',
+            'image-0', '2gb')
+
+    def test_poll_intervals_back_off(self):
+        intervals = self.slave._poll_intervals()
+        self.assertEqual([ intervals.next() for i in range(7) ],
+                         [1, 2, 4, 8, 16, 30, 30])
+
+    def test_wait_for_droplet(self):
+        statuses = ['new', 'new', 'new', 'active']
+        polls = []
+        def get_droplet():
+            polls.append(self.clock.seconds())
+            return defer.succeed(statuses.pop(0))
+        self.slave._get_droplet = get_droplet
+        d = self.slave._wait_for_droplet(lambda s: s == 'active', 'start')
+        self.clock.pump([1] * 10)
+        self.assertEqual(self.successResultOf(d), 'active')
+        self.assertEqual(polls, [0, 1, 3, 7])
+
+    def test_wait_cancelled(self):
+        self.slave._get_droplet = lambda: defer.succeed(None)
+        d = self.slave._wait_for_droplet(lambda s: s is not None, 'start')
+        self.clock.advance(1)
+        self.assertEqual(self.slave._waiting.keys(), ['start'])
+        self.slave._waiting['start'].cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.slave._waiting, {})
+
+    def test_wait_times_out(self):
+        self.slave.missing_timeout = 100
+        polls = []
+        def get_droplet():
+            polls.append(self.clock.seconds())
+            return defer.succeed(None)
+        self.slave._get_droplet = get_droplet
+        d = self.slave._wait_for_droplet(lambda s: s is not None, 'start')
+        self.clock.pump([1] * 99)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.failureResultOf(
+            d, interfaces.LatentBuildSlaveFailedToSubstantiate)
+        self.assertEqual(polls[-1], 100)
+
+    def test_waits_cancelled_separately(self):
+        self.slave._get_droplet = lambda: defer.succeed(None)
+        start = self.slave._wait_for_droplet(lambda s: s is not None, 'start')
+        end = self.slave._wait_for_droplet(lambda s: s is not None, 'end')
+        self.clock.advance(0)
+        self.slave._waiting['start'].cancel()
+        self.failureResultOf(start, defer.CancelledError)
+        self.assertNoResult(end)
+        self.slave._waiting['end'].cancel()
+        self.failureResultOf(end, defer.CancelledError)
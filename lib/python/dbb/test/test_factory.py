@@ -0,0 +1,76 @@
+# Build factory decisions
+
+from twisted.trial import unittest
+
+from buildbot.status.results import SUCCESS, FAILURE
+
+from dbb.factory import build_factory
+
+class fake_config(object):
+    build_mode = 'incremental'
+    full_build_every = 20
+
+class fake_build_status(object):
+    def __init__(self, slavename, results):
+        self.slavename = slavename
+        self.results = results
+
+    def getSlavename(self):
+        return self.slavename
+
+    def getResults(self):
+        return self.results
+
+class fake_builder_status(object):
+    def __init__(self, finished):
+        self.finished = finished  # newest first
+
+    def generateFinishedBuilds(self, num_builds=None, filter_fn=None):
+        got = [ b for b in self.finished if filter_fn is None or filter_fn(b) ]
+        return iter(got[:num_builds])
+
+class fake_build(object):
+    def __init__(self, slavename, number, finished):
+        self.slavename = slavename
+        self.properties = dict(buildnumber = number)
+        self.builder = type('builder', (object,), {})()
+        self.builder.builder_status = fake_builder_status(finished)
+
+    def getSlavename(self):
+        return self.slavename
+
+    def getProperty(self, name):
+        return self.properties.get(name)
+
+    def setProperty(self, name, value, source):
+        self.properties[name] = value
+
+class fake_step(object):
+    def __init__(self, build):
+        self.build = build
+
+class CleanBuildTest(unittest.TestCase):
+    def clean(self, slavename, finished, number=7):
+        factory = build_factory(fake_config(), dict(flavor = 'posix'))
+        return factory.clean_build(
+            fake_step(fake_build(slavename, number, finished)))
+
+    def test_first_build_on_slave(self):
+        self.assertTrue(self.clean('a', []))
+        self.assertTrue(self.clean('a', [fake_build_status('b', SUCCESS)]))
+
+    def test_after_success(self):
+        self.assertFalse(self.clean('a', [fake_build_status('a', SUCCESS)]))
+
+    def test_after_failure_on_this_slave(self):
+        # Another slave's later success doesn't fix this slave's tree
+        self.assertTrue(self.clean('a', [fake_build_status('b', SUCCESS),
+                                         fake_build_status('a', FAILURE)]))
+
+    def test_after_failure_on_other_slave(self):
+        self.assertFalse(self.clean('a', [fake_build_status('b', FAILURE),
+                                          fake_build_status('a', SUCCESS)]))
+
+    def test_full_build_every(self):
+        self.assertTrue(self.clean('a', [fake_build_status('a', SUCCESS)],
+                                   number=40))
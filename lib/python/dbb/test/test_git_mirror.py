@@ -0,0 +1,60 @@
+# Shared git mirror, against a local upstream repository
+
+import fcntl, os, shutil, subprocess, tempfile, time
+
+from twisted.trial import unittest
+
+from dbb.git_mirror import git_mirror
+
+class fake_config(object):
+    def __init__(self, tree, git_repo):
+        self.base_dir = tree
+        self.container_dir = tree
+        self.git_repo = git_repo
+        self.git_mirror = dict(enabled=True, refresh_interval=300)
+
+class GitMirrorTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.upstream = os.path.join(self.dir, 'upstream')
+        self.git('init', '-q', self.upstream)
+        self.git('-C', self.upstream, '-c', 'user.name=a',
+                 '-c', 'user.email=a@b', 'commit', '-q', '--allow-empty',
+                 '-m', 'initial')
+        self.mirror = git_mirror(
+            fake_config(os.path.join(self.dir, 'tree'), self.upstream))
+
+    def git(self, *args):
+        with open(os.devnull, 'w') as null:
+            return subprocess.check_output(('git',) + args, stderr=null)
+
+    def mirror_config(self, key):
+        return self.git('--git-dir=%s' % self.mirror.path,
+                        'config', key).strip()
+
+    def test_refresh(self):
+        self.mirror.refresh()
+        self.assertEqual(self.mirror.status()['branches'], 1)
+        self.assertEqual(self.mirror_config('gc.auto'), '0')
+        self.assertEqual(self.mirror_config('gc.pruneExpire'), 'never')
+
+    def test_poller_gitbin(self):
+        gitbin = self.mirror.poller_gitbin
+        self.assertEqual(self.mirror.poller_gitbin, gitbin)
+        # As GitPoller runs it each poll; configured once it exists
+        for i in range(2):
+            subprocess.check_call([gitbin, 'init', '-q', '--bare',
+                                   self.mirror.path])
+        self.assertEqual(self.mirror_config('gc.auto'), '0')
+
+    def test_poller_gitbin_waits_for_lock(self):
+        gitbin = self.mirror.poller_gitbin
+        with open(self.mirror.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            p = subprocess.Popen([gitbin, 'init', '-q', '--bare',
+                                  self.mirror.path])
+            time.sleep(0.3)
+            self.assertEqual(p.poll(), None)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            self.assertEqual(p.wait(), 0)
@@ -0,0 +1,78 @@
+# Idempotency checks of container initialization
+
+import os, shutil, tempfile
+
+from twisted.trial import unittest
+
+import dbb.init
+from dbb.init import init
+
+# The tracked, config-driven slave tac
+topdir = os.path.realpath(os.path.join(
+        os.path.dirname(__file__), '..', '..', '..', '..'))
+tracked_tac = os.path.join(topdir, 'slave', 'buildbot.tac')
+
+class fake_slave(object):
+    name = 's1'
+    base_image = 'debian:jessie'
+    password = 'secret'
+
+class fake_config(object):
+    maintainer_name = 'J. Doe'
+    maintainer_email = 'jdoe@example.com'
+    master_host = 'master.example.com'
+    hostname = 's1'
+
+class SlaveIsValidTest(unittest.TestCase):
+    def setUp(self):
+        self.config = fake_config()
+        self.config.slave = fake_slave()
+        self.config.slave.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.config.slave.dir)
+        self.init = init(self.config)
+
+    def create_slave(self):
+        shutil.copy(tracked_tac, self.init.slave_tac)
+        os.mkdir(os.path.join(self.config.slave.dir, 'info'))
+        for name, content in self.init.slave_info.items():
+            self.init.write_if_changed(
+                os.path.join(self.config.slave.dir, 'info', name), content)
+
+    def test_missing(self):
+        self.assertFalse(self.init.slave_is_valid())
+
+    def test_tracked_tac(self):
+        self.create_slave()
+        self.assertTrue(self.init.slave_is_valid())
+
+    def test_config_changes_keep_tracked_tac(self):
+        # The tracked tac reads these from the config at start
+        self.create_slave()
+        self.config.master_host = 'other.example.com'
+        self.config.slave.password = 'changed'
+        self.assertTrue(self.init.slave_is_valid())
+
+    def test_not_a_slave_tac(self):
+        self.create_slave()
+        with open(self.init.slave_tac, 'w') as f:
+            f.write("application = service.Application('buildmaster')\n")
+        self.assertFalse(self.init.slave_is_valid())
+
+    def test_stale_info(self):
+        self.create_slave()
+        self.config.maintainer_email = 'other@example.com'
+        self.assertFalse(self.init.slave_is_valid())
+
+    def test_buildbot_slave_keeps_tac(self):
+        # With stale info, create-slave runs but the tac is untouched
+        self.create_slave()
+        self.config.maintainer_email = 'other@example.com'
+        calls = []
+        self.patch(dbb.init.subprocess, 'call', calls.append)
+        with open(self.init.slave_tac, 'r') as f:
+            before = f.read()
+        self.init.buildbot_slave()
+        with open(self.init.slave_tac, 'r') as f:
+            self.assertEqual(f.read(), before)
+        self.assertEqual(calls[0][:2], ['buildslave', 'create-slave'])
+        self.assertTrue(self.init.slave_is_valid())
@@ -21,27 +21,251 @@ from __future__ import with_statement
 
 import os
 import re
+import threading
 import time
+import uuid
 
 import digitalocean
 
 from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
 from twisted.internet import threads
 from twisted.python import log
 
 from buildbot import interfaces
 from buildbot.buildslave.base import AbstractLatentBuildSlave
 
+from dbb import metrics
+from dbb.config import DigitalOceanSlaveConfig
+
+# python-digitalocean raises NotFoundError for missing droplets, or
+# DataReadError before it had one
+NotFoundError = (getattr(digitalocean.baseapi, 'NotFoundError',
+                         digitalocean.DataReadError),
+                 digitalocean.DataReadError)
+
+
+class DropletIndex(object):
+    """Droplet and image listings for one API token, shared by all
+    slaves and pools using the token.
+
+    Listings are cached for `droplet_ttl` and `image_ttl` seconds, so
+    many latent slaves polling at once make few API requests;
+    `invalidate()` after creating, renaming or destroying droplets.
+    """
+
+    droplet_ttl = 10
+    image_ttl = 5 * 60
+    _indexes = {}
+
+    @classmethod
+    def get(cls, token):
+        if token not in cls._indexes:
+            cls._indexes[token] = cls(token)
+        return cls._indexes[token]
+
+    def __init__(self, token):
+        self.mgr = digitalocean.Manager(token=token)
+        self.lock = threading.Lock()
+        self._droplets = (0, [])
+        self._images = (0, [])
+
+    def invalidate(self):
+        self._droplets = (0, [])
+
+    def droplets(self):
+        with self.lock:
+            fetched, droplets = self._droplets
+            if time.time() - fetched > self.droplet_ttl:
+                droplets = self.mgr.get_all_droplets()
+                self._droplets = (time.time(), droplets)
+        return droplets
+
+    def images(self):
+        with self.lock:
+            fetched, images = self._images
+            if time.time() - fetched > self.image_ttl:
+                images = self.mgr.get_my_images()
+                self._images = (time.time(), images)
+        return images
+
+    def droplet_by_name(self, name):
+        return ([ d for d in self.droplets() if d.name == name ] + [None])[0]
+
+    def droplet_by_id(self, droplet_id):
+        """Fetch a droplet directly, bypassing the cache"""
+        try:
+            return self.mgr.get_droplet(droplet_id)
+        except NotFoundError:
+            return None
+
+    def image_id(self, name):
+        return ([ i.id for i in self.images() if i.name == name ] + [None])[0]
+
+class DropletPool(object):
+    """A pool of idle, pre-started droplets for one image, region and
+    size, shared by all latent slaves using them.
+
+    Slaves claim an active idle droplet by renaming it and tagging it
+    with the slave's name; dbb in the droplet finds its slave from the
+    tag, since the droplet's hostname stays the pool name.  The pool
+    is replenished in the background.  When no droplet has been
+    claimed for `idle_ttl` seconds, the idle droplets are destroyed
+    until the next claim.  The pool won't grow beyond
+    `max_hourly_cost` dollars per hour of idle droplets.
+    """
+
+    name_prefix = DigitalOceanSlaveConfig.pool_name_prefix
+    _maintain_interval = 60
+    _pools = {}
+
+    @classmethod
+    def get(cls, token, image, region, size_slug, size, idle_ttl=60 * 60,
+            max_hourly_cost=None):
+        key = (token, image, region, size_slug)
+        if key not in cls._pools:
+            cls._pools[key] = cls(token, image, region, size_slug, size,
+                                  idle_ttl, max_hourly_cost)
+        else:
+            # Slaves sharing a pool may configure different sizes
+            pool = cls._pools[key]
+            pool.size = max(pool.size, size)
+        return cls._pools[key]
+
+    def __init__(self, token, image, region, size_slug, size, idle_ttl,
+                 max_hourly_cost):
+        self.token = token
+        self.image = image
+        self.region = region
+        self.size_slug = size_slug
+        self.size = size
+        self.idle_ttl = idle_ttl
+        self.max_hourly_cost = max_hourly_cost
+        self.index = DropletIndex.get(token)
+        self.lock = threading.Lock()
+        self.maintaining = False
+        self.last_claim = time.time()
+
+        self.loop = task.LoopingCall(self.kick)
+        reactor.callWhenRunning(self.loop.start, self._maintain_interval)
+
+    @property
+    def prefix(self):
+        name = '%s-%s-%s-%s' % (self.name_prefix, self.region,
+                                self.size_slug, self.image)
+        return re.sub(r'[^a-zA-Z0-9.-]', '-', name)
+
+    def _price_hourly(self):
+        if not hasattr(self, '_price'):
+            self._price = ([ s.price_hourly
+                             for s in self.index.mgr.get_all_sizes()
+                             if s.slug == self.size_slug ] + [0])[0]
+        return self._price
+
+    def idle(self):
+        """Idle pool droplets, oldest first"""
+        droplets = [ d for d in self.index.droplets()
+                     if d.name.startswith(self.prefix + '-') ]
+        return sorted(droplets, key=lambda d: d.created_at)
+
+    def claim(self, name):
+        """Rename an active idle droplet to `name` and return it, or
+        return None if none is ready; blocking"""
+        with self.lock:
+            for droplet in self.idle():
+                if droplet.status != 'active':
+                    continue
+                log.msg('DropletPool %s:  claiming droplet %s as %s' %
+                        (self.prefix, droplet.name, name))
+                tag = digitalocean.Tag(
+                    token=self.token,
+                    name=DigitalOceanSlaveConfig.slave_tag(name))
+                tag.create()
+                tag.add_droplets([droplet.id])
+                droplet.rename(name)
+                self.index.invalidate()
+                self.last_claim = time.time()
+                reactor.callFromThread(self.kick)
+                return droplet
+        return None
+
+    def kick(self):
+        """Maintain the pool in a thread, unless already in progress"""
+        if self.maintaining:
+            return
+        self.maintaining = True
+        d = threads.deferToThread(self.maintain)
+
+        def done(res):
+            self.maintaining = False
+            return res
+        d.addBoth(done)
+        d.addErrback(log.err, 'DropletPool %s maintenance failed' %
+                     self.prefix)
+        return d
+
+    def maintain(self):
+        """Destroy expired idle droplets and replenish the pool; blocking"""
+        with self.lock:
+            if time.time() - self.last_claim > self.idle_ttl:
+                target = 0
+            else:
+                target = self.size
+            idle = self.idle()
+            while len(idle) > target and idle[0].status == 'active':
+                droplet = idle.pop(0)
+                log.msg('DropletPool %s:  destroying idle droplet %s' %
+                        (self.prefix, droplet.name))
+                droplet.destroy()
+                self.index.invalidate()
+
+            wanted = target - len(idle)
+            if self.max_hourly_cost is not None and self._price_hourly():
+                affordable = int(self.max_hourly_cost /
+                                 self._price_hourly()) - len(idle)
+                wanted = min(wanted, affordable)
+            for i in range(wanted):
+                name = '%s-%s' % (self.prefix, uuid.uuid4().hex[:8])
+                log.msg('DropletPool %s:  creating droplet %s' %
+                        (self.prefix, name))
+                digitalocean.Droplet(
+                    token=self.token,
+                    name=name,
+                    region=self.region,
+                    image=self.index.image_id(self.image),
+                    size_slug=self.size_slug,
+                ).create()
+                self.index.invalidate()
+
+
 class DigitalOceanLatentBuildSlave(AbstractLatentBuildSlave):
+    """Latent slave whose lifecycle is driven by the reactor.
 
-    _poll_resolution = 5
+    DigitalOcean API requests run briefly in the thread pool, but
+    waits between droplet status polls are `deferLater` calls, so
+    substantiating slaves don't hold threads.  Waits give up after
+    `missing_timeout` seconds; a pending wait for the droplet to start
+    is cancelled by `stop_instance()`.
+
+    `phase_times` holds the seconds taken by the last substantiation's
+    phases:  `api_create` (droplet claimed or create request
+    returned), `active` (droplet active) and `connected` (slave
+    attached).
+    """
+
+    # Droplet status polling backs off exponentially from
+    # `_poll_initial` to `_poll_max` seconds
+    _poll_initial = 1
+    _poll_max = 30
 
     def __init__(self, name, password, droplet_name, token, region, image,
                  size_slug, backups=False,
                  max_builds=None, notify_on_missing=[], missing_timeout=60 * 20,
-                 build_wait_timeout=60 * 10, properties={}, locks=None):
+                 build_wait_timeout=60 * 10, properties={}, locks=None,
+                 pool_size=0, pool_idle_ttl=60 * 60,
+                 pool_max_hourly_cost=None):
 
-        build_wait_timeout = 60*10 # FIXME:  Wait for Docker to start?
         AbstractLatentBuildSlave.__init__(
             self, name, password, max_builds, notify_on_missing,
             missing_timeout, build_wait_timeout, properties, locks)
@@ -53,93 +277,167 @@ class DigitalOceanLatentBuildSlave(AbstractLatentBuildSlave):
         self.size_slug=size_slug
         self.backups=backups
 
-        self.mgr = digitalocean.Manager(token=token)
+        self.index = DropletIndex.get(token)
+        self.droplet_id = None
+        self.phase_times = {}
+        self._start_time = None
+        # Pending poll waits, by what's awaited
+        self._waiting = {}
+
+        if pool_size:
+            self.pool = DropletPool.get(
+                token, image, region, size_slug, pool_size,
+                idle_ttl=pool_idle_ttl, max_hourly_cost=pool_max_hourly_cost)
+        else:
+            self.pool = None
 
-    def _image_id(self):
-        return ([ i.id for i in self.mgr.get_my_images()
-                  if i.name == self.image ] + [None])[0]
+    def _poll_intervals(self):
+        interval = self._poll_initial
+        while True:
+            yield interval
+            interval = min(interval * 2, self._poll_max)
+
+    def _get_droplet(self):
+        """Look up the droplet in a thread"""
+        return threads.deferToThread(lambda: self.droplet)
+
+    def _phase(self, phase):
+        self.phase_times[phase] = time.time() - self._start_time
+        metrics.substantiation.observe(
+            self.phase_times[phase], slave=self.slavename, phase=phase)
+        log.msg('%s %s droplet %s phase %s after %.1f seconds' %
+                (self.__class__.__name__, self.slavename, self.name,
+                 phase, self.phase_times[phase]))
 
     def start_instance(self, build):
-        if self.droplet is not None:
-            raise ValueError('instance active')
-        return threads.deferToThread(self._create)
+        self._start_time = time.time()
+        self.phase_times = {}
+        return self._create()
 
+    @defer.inlineCallbacks
     def _create(self):
-        droplet = digitalocean.Droplet(
-            token=self.token,
-            name=self.name,
-            region=self.region,
-            image=self._image_id(),
-            size_slug=self.size_slug,
-            backups=self.backups,
-        )
-        log.msg("Creating slave %s in droplet %s:  "
-                "region=%s; image=%s; size=%s" %
-                (self.slavename, self.name, self.region,
-                 self._image_id(), self.size_slug))
-        droplet.create()
-        self._wait_for_droplet()
-
-        if self.droplet is None:
+        droplet = yield self._get_droplet()
+        if droplet is not None:
+            raise ValueError('instance active')
+
+        if self.pool is not None:
+            droplet = yield threads.deferToThread(self.pool.claim, self.name)
+        if droplet is not None:
+            log.msg("Claimed droplet %s for slave %s from pool" %
+                    (self.name, self.slavename))
+        else:
+            image_id = yield threads.deferToThread(
+                self.index.image_id, self.image)
+            droplet = digitalocean.Droplet(
+                token=self.token,
+                name=self.name,
+                region=self.region,
+                image=image_id,
+                size_slug=self.size_slug,
+                backups=self.backups,
+            )
+            log.msg("Creating slave %s in droplet %s:  "
+                    "region=%s; image=%s; size=%s" %
+                    (self.slavename, self.name, self.region,
+                     image_id, self.size_slug))
+            yield threads.deferToThread(droplet.create)
+            self.index.invalidate()
+        self.droplet_id = droplet.id
+        self._phase('api_create')
+
+        log.msg('%s %s waiting for droplet %s to start' %
+                (self.__class__.__name__, self.slavename, self.name))
+        droplet = yield self._wait_for_droplet(
+            lambda d: d is None or d.status == 'active', 'start')
+        if droplet is None:
             log.msg('%s %s failed to start droplet %s' %
                     (self.__class__.__name__, self.slavename, self.name))
             raise interfaces.LatentBuildSlaveFailedToSubstantiate(
                 self.name, 'non-existent')
+        self._phase('active')
+        log.msg('%s %s droplet %s started on %s' %
+                (self.__class__.__name__, self.slavename,
+                 self.name, droplet.ip_address))
 
-        return [self.name, self.droplet.id, self.droplet.created_at]
+        defer.returnValue([self.name, droplet.id, droplet.created_at])
 
-    def _wait_for_droplet(self):
-        log.msg('%s %s waiting for droplet %s to start' %
-                (self.__class__.__name__, self.slavename, self.name))
-        duration = 0
-        droplet = self.droplet
-        while droplet is None or droplet.status != 'active':
-            time.sleep(self._poll_resolution)
-            droplet = self.droplet
-            duration += self._poll_resolution
-            if droplet is None:
-                state = 'non-existent'
-            else:
-                state = droplet.status
-            log.msg('%s %s has waited %d minutes for droplet %s (current: %s)' %
-                    (self.__class__.__name__, self.slavename, duration // 60,
-                     self.name, state))
-        log.msg('%s %s droplet %s started on %s '
-                'in about %d seconds' %
-                (self.__class__.__name__, self.slavename,
-                 self.name, droplet.ip_address, duration))
+    @defer.inlineCallbacks
+    def _wait_for_droplet(self, done, what):
+        """Poll the droplet with backoff until `done(droplet)`; return
+        the droplet, or raise LatentBuildSlaveFailedToSubstantiate
+        after `missing_timeout` seconds"""
+        start = reactor.seconds()
+        intervals = self._poll_intervals()
+        droplet = yield self._get_droplet()
+        while not done(droplet):
+            duration = reactor.seconds() - start
+            if duration >= self.missing_timeout:
+                log.msg('%s %s gave up waiting for droplet %s to %s '
+                        'after %d seconds (current: %s)' %
+                        (self.__class__.__name__, self.slavename,
+                         self.name, what, duration,
+                         droplet and droplet.status or 'non-existent'))
+                raise interfaces.LatentBuildSlaveFailedToSubstantiate(
+                    self.name, 'timed out waiting to %s' % what)
+            interval = min(intervals.next(), self.missing_timeout - duration)
+            self._waiting[what] = task.deferLater(
+                reactor, interval, lambda: None)
+            try:
+                yield self._waiting[what]
+            finally:
+                del self._waiting[what]
+            droplet = yield self._get_droplet()
+            if (duration + interval) // 60 > duration // 60:
+                log.msg('%s %s has waited %d minutes for droplet %s to %s '
+                        '(current: %s)' %
+                        (self.__class__.__name__, self.slavename,
+                         (duration + interval) // 60, self.name, what,
+                         droplet and droplet.status or 'non-existent'))
+        defer.returnValue(droplet)
+
+    def attached(self, bot):
+        d = AbstractLatentBuildSlave.attached(self, bot)
+        if self._start_time is not None and \
+                'connected' not in self.phase_times:
+            self._phase('connected')
+        return d
 
     @property
     def droplet(self):
-        return ([ d for d in self.mgr.get_all_droplets() \
-                  if d.name == self.name ] + [None])[0]
+        """The slave's droplet, or None; fetched by ID once known"""
+        if self.droplet_id is None:
+            droplet = self.index.droplet_by_name(self.name)
+        else:
+            droplet = self.index.droplet_by_id(self.droplet_id)
+        self.droplet_id = droplet and droplet.id
+        return droplet
 
     def stop_instance(self, fast=False):
-        if self.droplet is None:
+        if 'start' in self._waiting:
+            # Abandon a substantiation still waiting for its droplet
+            self._waiting['start'].cancel()
+        return self._destroy_droplet(fast)
+
+    @defer.inlineCallbacks
+    def _destroy_droplet(self, fast=False):
+        droplet = yield self._get_droplet()
+        if droplet is None:
             # be gentle.  Something may just be trying to alert us that an
             # instance never attached, and it's because, somehow, we never
             # started.
             log.msg("stop_instance():  Droplet %s already stopped?  " \
                     "Doing nothing" % self.name)
-            return defer.succeed(None)
-        return threads.deferToThread(
-            self._destroy_droplet, fast)
-
-    def _destroy_droplet(self, fast=False):
-        droplet = self.droplet
-        if droplet is None:
             return
         log.msg('stop_instance(): Deleting droplet "%s"' % self.name)
-        droplet.destroy()
-        duration = 0
-        while self.droplet is not None:
-            time.sleep(self._poll_resolution)
-            duration += self._poll_resolution
-            if duration % 60 == 0:
-                log.msg(
-                    '%s %s has waited %d minutes for droplet %s to end' %
-                    (self.__class__.__name__, self.slavename, duration // 60,
-                     self.name))
+        start = time.time()
+        yield threads.deferToThread(droplet.destroy)
+        self.index.invalidate()
+        try:
+            yield self._wait_for_droplet(lambda d: d is None, 'end')
+        except interfaces.LatentBuildSlaveFailedToSubstantiate:
+            # Logged; the destroy request was accepted
+            return
+        duration = time.time() - start
         log.msg('%s %s droplet %s deleted '
                 'after about %d minutes %d seconds' %
                 (self.__class__.__name__, self.slavename,
@@ -0,0 +1,134 @@
+"""A LatentSlave that runs each build's slave in a local Docker container.
+"""
+
+import pipes
+import time
+
+import docker
+
+from twisted.internet import threads
+from twisted.python import log
+
+from buildbot import interfaces
+from buildbot.buildslave.base import AbstractLatentBuildSlave
+
+from dbb.container import container
+from dbb import metrics
+
+
+class DockerLatentBuildSlave(AbstractLatentBuildSlave):
+    """Latent slave whose worker is a container started from a dbb
+    host's image.
+
+    The worker container, named after the slave, runs a buildslave
+    created in the container's own filesystem, so workers on one host
+    don't share slave directories.  Docker API requests run in the
+    thread pool.  With `keep_warm`, idle workers' containers are
+    stopped but kept, so the next substantiation just restarts them;
+    otherwise they're removed.
+
+    `phase_times` holds the seconds taken by the last substantiation's
+    phases:  `started` (container running) and `connected` (slave
+    attached).
+    """
+
+    worker_dir = '/home/docker/worker'
+
+    def __init__(self, name, password, config, keep_warm=False,
+                 max_builds=1, notify_on_missing=[], missing_timeout=60 * 20,
+                 build_wait_timeout=60, properties={}, locks=None):
+
+        AbstractLatentBuildSlave.__init__(
+            self, name, password, max_builds, notify_on_missing,
+            missing_timeout, build_wait_timeout, properties, locks)
+
+        self.config = config
+        self.keep_warm = keep_warm
+        self.docker = container(config)
+        self.phase_times = {}
+        self._start_time = None
+
+    @property
+    def worker_command(self):
+        """Create the worker's buildslave if needed and run it"""
+        create = ' '.join([ pipes.quote(a) for a in [
+                    'buildslave', 'create-slave', self.worker_dir,
+                    '%s:9989' % self.config.master_host, self.slavename,
+                    self.password ] ])
+        return ['/bin/sh', '-c',
+                'test -f %(dir)s/buildbot.tac || %(create)s && '
+                'cd %(dir)s && '
+                'exec twistd --nodaemon --no_save -y buildbot.tac' %
+                dict(dir=self.worker_dir, create=create)]
+
+    def _inspect(self):
+        """The worker container's inspect data, or None"""
+        try:
+            return self.docker.c.inspect_container(self.slavename)
+        except docker.errors.APIError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            return None
+
+    def _phase(self, phase):
+        self.phase_times[phase] = time.time() - self._start_time
+        metrics.substantiation.observe(
+            self.phase_times[phase], slave=self.slavename, phase=phase)
+        log.msg('%s %s phase %s after %.1f seconds' %
+                (self.__class__.__name__, self.slavename,
+                 phase, self.phase_times[phase]))
+
+    def start_instance(self, build):
+        self._start_time = time.time()
+        self.phase_times = {}
+        return threads.deferToThread(self._start)
+
+    def _start(self):
+        info = self._inspect()
+        if info is not None and info['State']['Running']:
+            # Left over from a master restart or failed stop
+            log.msg("Removing stale worker container %s" % self.slavename)
+            self.docker.c.remove_container(self.slavename, force=True)
+            info = None
+        if info is None:
+            log.msg("Creating worker container %s from image %s" %
+                    (self.slavename, self.config.hostname))
+            info = self.docker.create_container(
+                self.worker_command, name=self.slavename, publish=False)
+        else:
+            log.msg("Restarting worker container %s" % self.slavename)
+        try:
+            self.docker.c.start(self.slavename)
+        except docker.errors.APIError as e:
+            log.msg('%s %s failed to start:  %s' %
+                    (self.__class__.__name__, self.slavename, e))
+            raise interfaces.LatentBuildSlaveFailedToSubstantiate(
+                self.slavename, 'failed to start')
+        self._phase('started')
+        return [self.slavename, info['Id']]
+
+    def attached(self, bot):
+        d = AbstractLatentBuildSlave.attached(self, bot)
+        if self._start_time is not None and \
+                'connected' not in self.phase_times:
+            self._phase('connected')
+        return d
+
+    def stop_instance(self, fast=False):
+        return threads.deferToThread(self._stop, fast)
+
+    def _stop(self, fast=False):
+        info = self._inspect()
+        if info is None:
+            log.msg("stop_instance():  Worker container %s already "
+                    "removed?  Doing nothing" % self.slavename)
+            return
+        if info['State']['Running']:
+            self.docker.c.stop(self.slavename, timeout=1 if fast else 10)
+        if self.keep_warm:
+            log.msg("stop_instance():  Stopped worker container %s" %
+                    self.slavename)
+        else:
+            self.docker.c.remove_container(self.slavename)
+            log.msg("stop_instance():  Removed worker container %s" %
+                    self.slavename)